@@ -0,0 +1,138 @@
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from rpc import RpcConnection
+
+# A name node and DataNodes started as separate processes on localhost, each in its own temporary folder.
+#   async with LocalCluster(datanodes=4) as cluster:
+#       master = await RpcConnection.connect(cluster.uri)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LocalCluster:
+    START_TIMEOUT = 30  # seconds to wait for the name node and all DataNodes
+
+    def __init__(self, datanodes=4, master_port=8600, engine='file', log_level='WARNING', keep=False):
+        self.datanodes = datanodes
+        self.master_port = master_port
+        self.engine = engine
+        self.log_level = log_level
+        self.keep = keep  # leave the folders and logs behind for a look after the run
+        self.folder = None
+        self.master = None
+        self.nodes = []  # (port, process), None in place of a killed process
+        self.logs = []
+
+    @property
+    def uri(self):
+        return f'ws://localhost:{self.master_port}'
+
+    def datanode_ports(self):
+        return [self.master_port + 1 + index for index in range(self.datanodes)]
+
+    def spawn(self, name, *args):
+        folder = os.path.join(self.folder, name)
+        os.makedirs(folder, exist_ok=True)
+        env = dict(os.environ, PYTHONPATH=ROOT, DFS_LOG_LEVEL=self.log_level)
+        log = open(os.path.join(self.folder, f'{name}.log'), 'wb')
+        self.logs.append(log)
+        return subprocess.Popen([sys.executable, *args], cwd=folder, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    async def start(self):
+        self.folder = tempfile.mkdtemp(prefix='dfs-cluster-')
+        self.master = self.spawn('master', os.path.join(ROOT, 'masternode', 'master.py'),
+                                 str(self.master_port), 'metadata')
+        await self.wait_for_master()
+        for port in self.datanode_ports():
+            process = self.spawn(f'datanode-{port}', os.path.join(ROOT, 'datanode', 'datanode.py'),
+                                 f'localhost:{self.master_port}', f'localhost:{port}', self.engine)
+            self.nodes.append((port, process))
+        await self.wait_for_stores(self.datanodes)
+        return self
+
+    async def wait_for_master(self):
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            try:
+                websocket = await websockets.connect(self.uri, compression=None)
+                await websocket.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.master.poll() is not None:
+                    raise ConnectionError(f'Name node did not start, see {self.folder}/master.log')
+                await asyncio.sleep(0.1)
+
+    async def stores(self):
+        master = await RpcConnection.connect(self.uri)
+        try:
+            return await master.request('stores')
+        finally:
+            await master.close()
+
+    async def wait_for_stores(self, alive, timeout=START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while sum(1 for store in await self.stores() if store['state'] == 'alive') != alive:
+            if time.monotonic() > deadline:
+                raise ConnectionError(f'{alive} DataNodes were expected, see the logs in {self.folder}')
+            await asyncio.sleep(0.2)
+
+    def kill_datanode(self, index):
+        port, process = self.nodes[index]
+        process.kill()
+        process.wait()
+        self.nodes[index] = (port, None)
+        return f'localhost:{port}'
+
+    def kill_master(self):
+        # SIGKILL, nothing is flushed or closed on the way out
+        self.master.kill()
+        self.master.wait()
+
+    async def restart_master(self):
+        # the new name node starts from the metadata folder of the old one
+        self.master = self.spawn('master', os.path.join(ROOT, 'masternode', 'master.py'),
+                                 str(self.master_port), 'metadata')
+        await self.wait_for_master()
+
+    def pause_datanode(self, index):
+        # the process stops without closing its connections, like a node stuck on a bad disk
+        self.nodes[index][1].send_signal(signal.SIGSTOP)
+
+    def resume_datanode(self, index):
+        self.nodes[index][1].send_signal(signal.SIGCONT)
+
+    async def stop(self):
+        processes = [process for _, process in self.nodes if process is not None] + [self.master]
+        for process in processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                try:
+                    process.wait(5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.nodes = []
+        for log in self.logs:
+            log.close()
+        if not self.keep and self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    async def __aenter__(self):
+        try:
+            return await self.start()
+        except BaseException:
+            await self.stop()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
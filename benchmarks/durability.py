@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+
+from benchmarks.cluster import LocalCluster
+from rpc import RpcConnection
+
+# Kills the name node with SIGKILL right after it acknowledged metadata edits and checks that every
+# acknowledged edit is there after the restart. Run from the repository root:
+# python -m benchmarks.durability --edits 200 --concurrency 8
+
+
+async def make_dirs(master, names, concurrency):
+    # directories are made by concurrent requests, replies may share one fsync of the edit log
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def make(name):
+        async with semaphore:
+            response = await master.call('mk', name)
+            if response.get('error') is not None:
+                raise ConnectionError(f'mk {name}: {response["error"]}')
+
+    await asyncio.gather(*[make(name) for name in names])
+
+
+async def run(args):
+    names = [f'd{index}' for index in range(args.edits)]
+    async with LocalCluster(datanodes=0, master_port=args.port) as cluster:
+        for round_number in range(args.rounds):
+            round_names = [f'{name}-{round_number}' for name in names]
+            master = await RpcConnection.connect(cluster.uri)
+            await make_dirs(master, round_names, args.concurrency)
+            cluster.kill_master()
+            await cluster.restart_master()
+
+            master = await RpcConnection.connect(cluster.uri)
+            listed = set(await master.request('ls', '-a'))
+            await master.close()
+            lost = [name for name in round_names if f'/{name}' not in listed]
+            print(f'Round {round_number}: {len(round_names) - len(lost)} of {len(round_names)} '
+                  f'acknowledged edits survived the kill')
+            if len(lost) > 0:
+                raise SystemExit(f'Lost acknowledged edits: {", ".join(lost[:10])}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Acknowledged name node edits survive a killed process')
+    parser.add_argument('--edits', type=int, default=200, help='directories made before each kill')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8600)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
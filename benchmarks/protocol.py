@@ -0,0 +1,64 @@
+import argparse
+import base64
+import json
+import os
+import timeit
+
+from protocol import pack_request, pack_response, unpack_request, unpack_response
+
+# Cost of building and parsing one message: space-split text commands with json answers
+# against the binary frames of protocol.py. Run from the repository root:
+# python -m benchmarks.protocol --number 20000
+
+CHUNK = os.urandom(64 * 2 ** 10)
+INFO = 'File took 1.0 Mb. Distribute in 16 chunks, 0 shared with other files'
+LOCATIONS = [[f'chunk{index:04}', [['localhost', str(8500 + replica)] for replica in range(3)],
+              1234567890, 'zlib', 65536, 0, 65536, None] for index in range(16)]
+
+
+def text_cases():
+    # (name, serialize, parse) over the same message in the text protocol
+    info = 'info /dir/file.txt'
+    info_reply = json.dumps({'body': INFO})
+    read_reply = json.dumps({'body': LOCATIONS})
+    chunk_reply = json.dumps({'body': base64.b64encode(CHUNK).decode('utf-8')})
+    return [
+        ('request info', lambda: ' '.join(['info', '/dir/file.txt']), lambda: info.split(' ')),
+        ('reply text', lambda: json.dumps({'body': INFO}), lambda: json.loads(info_reply)['body']),
+        ('reply locations', lambda: json.dumps({'body': LOCATIONS}), lambda: json.loads(read_reply)['body']),
+        ('reply 64 Kb chunk', lambda: json.dumps({'body': base64.b64encode(CHUNK).decode('utf-8')}),
+         lambda: base64.b64decode(json.loads(chunk_reply)['body'])),
+    ]
+
+
+def binary_cases():
+    info = pack_request('info', '/dir/file.txt')
+    info_reply = pack_response(INFO)
+    read_reply = pack_response(LOCATIONS)
+    chunk_reply = pack_response(CHUNK)
+    return [
+        ('request info', lambda: pack_request('info', '/dir/file.txt'), lambda: unpack_request(info)),
+        ('reply text', lambda: pack_response(INFO), lambda: unpack_response(info_reply)),
+        ('reply locations', lambda: pack_response(LOCATIONS), lambda: unpack_response(read_reply)),
+        ('reply 64 Kb chunk', lambda: pack_response(CHUNK), lambda: unpack_response(chunk_reply)),
+    ]
+
+
+def measure(function, number):
+    # microseconds per call, the best of 5 runs
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 10 ** 6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wire protocol serialize and parse microbenchmark')
+    parser.add_argument('--number', type=int, default=20000, help='calls per measurement')
+    args = parser.parse_args()
+
+    print(f'{"message":<20}{"text build":>12}{"text parse":>12}{"binary build":>14}{"binary parse":>14}  us')
+    for (name, text_build, text_parse), (_, binary_build, binary_parse) in zip(text_cases(), binary_cases()):
+        print(f'{name:<20}{measure(text_build, args.number):>12.2f}{measure(text_parse, args.number):>12.2f}'
+              f'{measure(binary_build, args.number):>14.2f}{measure(binary_parse, args.number):>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from datanode.datanode import DataNode
+from node import Node, dispatch_table
+from protocol import pack_request, unpack_response
+
+# Memory allocated and time taken by one chunk read on a DataNode, from the request to the frame handed
+# to the websocket, for every read path. No network and no name node. Run from the repository root:
+# python -m benchmarks.reads --chunks 256 --engine segment
+
+
+def make_node(folder, engine):
+    # a DataNode that never registered with a name node, only its storage and request handling are used
+    node = DataNode.__new__(DataNode)
+    Node.__init__(node)
+    node.host, node.port = 'localhost', 0
+    node.storage = DataNode.ENGINES[engine](folder)
+    # the binary read as it was before, served through the same dispatch to compare like with like
+    node.binary_commands.update(dispatch_table({'read_copied': read_copied}, takes_payload=True))
+    return node
+
+
+def read_copied(node, chunk_name, payload):
+    # the chunk is read into new bytes, which are copied again into the response frame
+    return node.storage.read(chunk_name)
+
+
+def read_paths(node, chunk_names, batch):
+    # (name, chunks per call, coroutine function reading chunk number index)
+    async def text(index):
+        return json.dumps(await node.run_text(f'read {chunk_names[index]}'))
+
+    async def copied(index):
+        return await node.execute_binary(pack_request('read_copied', chunk_names[index]))
+
+    async def zero_copy(index):
+        frame = await node.execute_binary(pack_request('read', chunk_names[index]))
+        node.buffers.release(frame)
+        return frame
+
+    async def batched(index):
+        start = index * batch % len(chunk_names)
+        frame = await node.execute_binary(pack_request('read_batch', *chunk_names[start:start + batch]))
+        node.buffers.release(frame)
+        return frame
+
+    return [
+        ('text, base64 json', 1, text),
+        ('binary, copied', 1, copied),
+        ('binary, in place', 1, zero_copy),
+        (f'batch of {batch}', batch, batched),
+    ]
+
+
+async def measure(read, calls):
+    # peak bytes allocated during one call, averaged, and microseconds per call
+    tracemalloc.start()
+    allocated = 0
+    for index in range(calls):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await read(index)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for index in range(calls):
+        await read(index)
+    return allocated / calls, (time.perf_counter() - started) / calls * 10 ** 6
+
+
+async def run(args):
+    folder = tempfile.mkdtemp(prefix='dfs-reads-')
+    try:
+        node = make_node(folder, args.engine)
+        chunk_names = [f'chunk-{index:05}' for index in range(args.chunks)]
+        for chunk_name in chunk_names:
+            node.storage.write(chunk_name, os.urandom(Node.CHUNK_SIZE))
+        # the batch answers the same bytes as single reads
+        frames = unpack_response(await node.execute_binary(pack_request('read_batch', *chunk_names[:2])))
+        assert [bytes(unpack_response(frame)) for frame in frames] == [node.storage.read(name)
+                                                                       for name in chunk_names[:2]]
+        print(f'{"path":<22}{"bytes allocated":>18}{"us":>10}  per chunk, {args.engine} storage')
+        for name, chunks, read in read_paths(node, chunk_names, args.batch):
+            calls = max(args.chunks // chunks, 1)
+            allocated, microseconds = await measure(read, calls)
+            print(f'{name:<22}{allocated / chunks:>18,.0f}{microseconds / chunks:>10.1f}')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Allocations per chunk read on a DataNode')
+    parser.add_argument('--chunks', type=int, default=256, help='chunks stored and read')
+    parser.add_argument('--batch', type=int, default=16, help='chunks per batch read')
+    parser.add_argument('--engine', default='file', choices=list(DataNode.ENGINES))
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import shutil
+import tempfile
+import time
+
+from masternode.master import Master, generate_chunk_name
+
+# Measures how long a master needs to restart from a snapshot plus an edit log tail.
+# Run from the repository root: python -m benchmarks.restart --chunks 10000000
+
+
+def fill(master, chunks, chunks_per_file, stores):
+    written = 0
+    file_index = 0
+    while written < chunks:
+        count = min(chunks_per_file, chunks - written)
+        file_chunks = [(generate_chunk_name(), [stores[(written + i + r) % len(stores)] for r in range(3)])
+                       for i in range(count)]
+        master.commit('write', f'/file-{file_index}', file_chunks)
+        written += count
+        file_index += 1
+    return file_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Master restart time benchmark')
+    parser.add_argument('--chunks', type=int, default=10_000_000)
+    parser.add_argument('--chunks-per-file', type=int, default=1000)
+    parser.add_argument('--tail', type=int, default=10_000, help='edits left in the log after the snapshot')
+    parser.add_argument('--stores', type=int, default=16)
+    args = parser.parse_args()
+
+    meta_path = tempfile.mkdtemp(prefix='dfs-restart-')
+    stores = [('localhost', str(8500 + i)) for i in range(args.stores)]
+    try:
+        master = Master(meta_path)
+        master.edit_log.SNAPSHOT_EVERY = float('inf')
+        started = time.perf_counter()
+        files = fill(master, args.chunks, args.chunks_per_file, stores)
+        print(f'Wrote {args.chunks} chunks in {files} files: {time.perf_counter() - started:.2f} s')
+
+        # only the copy blocks the master's event loop, the rest runs in a thread
+        started = time.perf_counter()
+        tables = master.copy_tables()
+        txid = master.edit_log.start_snapshot()
+        copied = time.perf_counter() - started
+        master.write_snapshot(tables, txid)
+        print(f'Saved snapshot: {time.perf_counter() - started:.2f} s, event loop blocked {copied:.3f} s')
+
+        for i in range(args.tail):
+            master.commit('create', f'/tail-{i}')
+        master.edit_log.close()
+
+        started = time.perf_counter()
+        restarted = Master(meta_path)
+        elapsed = time.perf_counter() - started
+        print(f'Restarted with {len(restarted.chunk_to_replicas)} chunks, '
+              f'{len(restarted.file_to_chunks)} files: {elapsed:.2f} s')
+    finally:
+        shutil.rmtree(meta_path)
+
+
+if __name__ == '__main__':
+    main()
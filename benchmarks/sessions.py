@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import websockets
+
+from masternode.master import Master
+
+# Many clients work with one master at once, each in its own directory, and check that
+# nobody sees the files of another session. Run from the repository root:
+# python -m benchmarks.sessions --clients 200 --operations 50
+
+
+async def run_client(uri, index, operations, latencies):
+    errors = 0
+    async with websockets.connect(uri, max_size=None, compression=None) as websocket:
+        async def request(command):
+            started = time.perf_counter()
+            await websocket.send(command)
+            response = json.loads(await websocket.recv())
+            latencies.append(time.perf_counter() - started)
+            return response
+
+        await request(f'mk /client-{index}')
+        await request(f'cd /client-{index}')
+        own_files = set()
+        for operation in range(operations):
+            filename = f'file-{operation}'
+            await request(f'create {filename}')
+            own_files.add(filename)
+            # relative names resolve in the working directory of this session only
+            if set((await request('ls')).get('body', [])) != own_files:
+                errors += 1
+            if (await request(f'info /client-{index}/{filename}')).get('body') is None:
+                errors += 1
+    return errors
+
+
+async def run(uri, clients, operations):
+    latencies = []
+    started = time.perf_counter()
+    errors = await asyncio.gather(*[run_client(uri, index, operations, latencies) for index in range(clients)])
+    return time.perf_counter() - started, sorted(latencies), sum(1 for count in errors if count > 0)
+
+
+async def serve(master, port, clients, operations):
+    async with websockets.serve(master.execute, 'localhost', port, max_size=None, compression=None):
+        # the master logs every command, that is not what is measured here
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return await run(f'ws://localhost:{port}', clients, operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent client sessions load test')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--operations', type=int, default=50, help='files every client creates')
+    parser.add_argument('--port', type=int, default=8490)
+    args = parser.parse_args()
+
+    meta_path = tempfile.mkdtemp(prefix='dfs-sessions-')
+    try:
+        master = Master(meta_path)
+        elapsed, latencies, wrong = asyncio.run(serve(master, args.port, args.clients, args.operations))
+        master.edit_log.close()
+        print(f'{args.clients} clients, {len(latencies)} requests in {elapsed:.2f} s: '
+              f'{len(latencies) / elapsed:.0f} requests/s')
+        print(f'latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms')
+        print(f'sessions that saw another directory: {wrong}')
+    finally:
+        shutil.rmtree(meta_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from benchmarks.cluster import ROOT, LocalCluster
+from client.client import Client
+from metrics import configure_logging
+from rpc import RpcConnection
+
+# Repeatable workloads against a local cluster of separate processes. Results are printed and saved as json,
+# so the runs of two commits can be compared. Run from the repository root:
+# python -m benchmarks.suite --datanodes 4 --output before.json
+# python -m benchmarks.suite --compare before.json after.json
+
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+HEAL_TIMEOUT = 120  # seconds to wait for re-replication after a DataNode is killed
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 3),
+    }
+
+
+def make_file(path, size, seed):
+    # random bytes, the same for every run, so compression and deduplication do not change the numbers
+    rng = random.Random(seed)
+    with open(path, 'wb') as file:
+        for offset in range(0, size, 2 ** 20):
+            file.write(rng.randbytes(min(2 ** 20, size - offset)))
+
+
+async def write(client, master, path):
+    result = await client.write(master, f'write {path}')
+    if 'success' not in result:
+        raise ConnectionError(result)
+
+
+async def read(client, master, filename):
+    remote_file = await client.open(master, filename)
+    try:
+        return await remote_file.read()
+    finally:
+        remote_file.close()
+
+
+async def sequential(cluster, client, master, folder, args):
+    # one large file written and read back
+    path = os.path.join(folder, 'sequential.bin')
+    make_file(path, args.file_size, seed=1)
+    started = time.perf_counter()
+    await write(client, master, path)
+    write_time = time.perf_counter() - started
+    started = time.perf_counter()
+    data = await read(client, master, 'sequential.bin')
+    read_time = time.perf_counter() - started
+    with open(path, 'rb') as file:
+        if data != file.read():
+            raise ValueError('Read back data differs from the written file')
+    return {
+        'bytes': args.file_size,
+        'write_mb_s': round(args.file_size / write_time / 2 ** 20, 2),
+        'read_mb_s': round(args.file_size / read_time / 2 ** 20, 2),
+    }
+
+
+async def small(cluster, client, master, folder, args):
+    # a directory of small files written in one go, then read back one by one
+    directory = os.path.join(folder, 'small')
+    os.makedirs(directory)
+    rng = random.Random(2)
+    total = 0
+    for index in range(args.small_files):
+        size = rng.randint(2 ** 10, 64 * 2 ** 10)
+        make_file(os.path.join(directory, f'file-{index}.bin'), size, seed=index)
+        total += size
+    await master.request('mk', '/small')
+    await master.request('cd', '/small')
+    try:
+        started = time.perf_counter()
+        await write(client, master, directory)
+        write_time = time.perf_counter() - started
+        latencies = []
+        started = time.perf_counter()
+        for index in range(args.small_files):
+            file_started = time.perf_counter()
+            await read(client, master, f'file-{index}.bin')
+            latencies.append(time.perf_counter() - file_started)
+        read_time = time.perf_counter() - started
+    finally:
+        await master.request('cd', '/')
+    return {
+        'files': args.small_files,
+        'bytes': total,
+        'write_files_s': round(args.small_files / write_time, 1),
+        'write_mb_s': round(total / write_time / 2 ** 20, 2),
+        'read_files_s': round(args.small_files / read_time, 1),
+        **{f'read_{name}': value for name, value in percentiles(latencies).items()},
+    }
+
+
+async def metadata_worker(uri, index, operations, latencies):
+    # every worker is a session of its own that works in its own directory
+    master = await RpcConnection.connect(uri)
+    try:
+        async def timed(operation, *args):
+            started = time.perf_counter()
+            await master.request(operation, *args)
+            latencies.setdefault(operation, []).append(time.perf_counter() - started)
+
+        await timed('mk', f'/meta-{index}')
+        await timed('cd', f'/meta-{index}')
+        for operation in range(operations):
+            await timed('create', f'file-{operation}')
+            await timed('info', f'file-{operation}')
+            await timed('ls')
+            await timed('mk', f'dir-{operation}')
+            await timed('cd', f'dir-{operation}')
+            await timed('cd', '..')
+    finally:
+        await master.close()
+
+
+async def metadata(cluster, client, master, folder, args):
+    latencies = {}
+    started = time.perf_counter()
+    await asyncio.gather(*[metadata_worker(cluster.uri, index, args.operations, latencies)
+                           for index in range(args.workers)])
+    elapsed = time.perf_counter() - started
+    count = sum(len(values) for values in latencies.values())
+    result = {'operations': count, 'ops_s': round(count / elapsed, 1),
+              **percentiles([value for values in latencies.values() for value in values])}
+    for operation, values in sorted(latencies.items()):
+        result.update({f'{operation}_{name}': value for name, value in percentiles(values).items()})
+    return result
+
+
+async def degraded(cluster, client, master, folder, args):
+    # a DataNode stops answering without closing its connections, random reads have to go around it
+    path = os.path.join(folder, 'degraded.bin')
+    make_file(path, args.file_size // 4, seed=4)
+    await write(client, master, path)
+    remote_file = await client.open(master, 'degraded.bin')
+    rng = random.Random(5)
+    hedged = client.metrics.counters.get('hedged_reads', 0)
+    latencies = []
+    cluster.pause_datanode(0)
+    try:
+        for _ in range(args.degraded_reads):
+            remote_file.seek(rng.randrange(remote_file.size - 2 ** 16))
+            started = time.perf_counter()
+            await remote_file.read(2 ** 16)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        cluster.resume_datanode(0)
+        remote_file.close()
+    return {
+        'reads': args.degraded_reads,
+        'hedged': client.metrics.counters.get('hedged_reads', 0) - hedged,
+        **{f'read_{name}': value for name, value in percentiles(latencies).items()},
+    }
+
+
+async def failover(cluster, client, master, folder, args):
+    # a DataNode is killed while a large file is written, the file has to be readable afterwards
+    # and the name node has to bring all chunks back to full replication
+    path = os.path.join(folder, 'failover.bin')
+    make_file(path, args.file_size, seed=3)
+    started = time.perf_counter()
+    writing = asyncio.ensure_future(write(client, master, path))
+    await asyncio.sleep(args.kill_after)
+    cluster.kill_datanode(0)
+    killed = time.perf_counter()
+    await writing
+    write_time = time.perf_counter() - started
+    data = await read(client, master, 'failover.bin')
+    with open(path, 'rb') as file:
+        read_ok = data == file.read()
+    while True:
+        gauges = (await master.request('stats'))['gauges']
+        if gauges['stores_alive'] == args.datanodes - 1 and gauges['under_replicated'] == 0:
+            break
+        if time.perf_counter() - killed > HEAL_TIMEOUT:
+            raise TimeoutError(f'{gauges["under_replicated"]} chunks are still under-replicated')
+        await asyncio.sleep(0.5)
+    return {
+        'bytes': args.file_size,
+        'write_mb_s': round(args.file_size / write_time / 2 ** 20, 2),
+        'read_ok': read_ok,
+        'heal_s': round(time.perf_counter() - killed, 2),
+    }
+
+
+# in the order they run, failover kills a DataNode so it goes last
+WORKLOADS = {
+    'sequential': sequential,
+    'small': small,
+    'metadata': metadata,
+    'degraded': degraded,
+    'failover': failover,
+}
+
+
+async def run(args):
+    results = {}
+    async with LocalCluster(args.datanodes, args.port, args.engine, keep=args.keep) as cluster:
+        client = Client(max_in_flight=args.window)
+        master = await RpcConnection.connect(cluster.uri)
+        folder = tempfile.mkdtemp(prefix='dfs-bench-')
+        try:
+            for name, workload in WORKLOADS.items():
+                if name not in args.workloads:
+                    continue
+                # the client reports every transfer on stdout, that is not what is measured here
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    results[name] = await workload(cluster, client, master, folder, args)
+                print(name, json.dumps(results[name]), flush=True)
+        finally:
+            await master.close()
+            await client.pool.close()
+            shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    # change of every time and rate in percent; latencies and heal time should go down, rates (*_s) up
+    with open(before_path) as file:
+        before = json.load(file)
+    with open(after_path) as file:
+        after = json.load(file)
+    print(f'{before.get("commit")} -> {after.get("commit")}')
+    for workload, metrics in after['results'].items():
+        for name, value in metrics.items():
+            old = before['results'].get(workload, {}).get(name)
+            if not name.endswith(('_s', '_ms')) or isinstance(value, bool) or not old:
+                continue
+            change = (value - old) / old * 100
+            worse = change > 0 if name.endswith(('_ms', 'heal_s')) else change < 0
+            print(f'{workload:<12}{name:<24}{old:>12}{value:>12}{change:>+9.1f}%{"  worse" if worse else ""}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmarks on a local cluster')
+    parser.add_argument('--datanodes', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8600, help='port of the name node, DataNodes take the next ones')
+    parser.add_argument('--engine', default='file', choices=['file', 'segment'])
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS), choices=list(WORKLOADS))
+    parser.add_argument('--file-size', type=int, default=32 * 2 ** 20, help='bytes of the large files')
+    parser.add_argument('--small-files', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=8, help='concurrent sessions of the metadata workload')
+    parser.add_argument('--operations', type=int, default=100, help='rounds of every metadata worker')
+    parser.add_argument('--window', type=int, default=Client.MAX_IN_FLIGHT, help='chunks in flight of the client')
+    parser.add_argument('--degraded-reads', type=int, default=200, help='random reads with a DataNode paused')
+    parser.add_argument('--kill-after', type=float, default=0.5, help='seconds into the failover write')
+    parser.add_argument('--keep', action='store_true', help='keep the cluster folders and logs')
+    parser.add_argument('--output', help='json file for the results, benchmarks/results/ by default')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if 'failover' in args.workloads and args.datanodes < 4:
+        parser.error('failover needs at least 4 DataNodes, so 3 replicas fit after one is killed')
+
+    # replicas of the killed DataNode are skipped with a warning on every read
+    configure_logging('ERROR')
+    results = asyncio.run(run(args))
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'results': results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        output = os.path.join(RESULTS, f'{commit or "unknown"}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Results saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import logging
+import os
+import pickle
+from collections import OrderedDict
+
+from protocol import checksum
+
+log = logging.getLogger('cache')
+
+
+class ChunkCache:
+    # whole chunks as they are stored on DataNodes, a file each, keyed by the chunk name;
+    # names are hashes of the content, so a cached chunk never goes stale. A hit is checked against
+    # the checksum the master hands out with the location, a chunk written again with another codec is a miss
+    SIZE = 2 ** 30  # 1Gb
+    SAVE_EVERY = 100  # changes between index saves, the index is saved on close too
+    SUFFIX = '.bin'
+
+    def __init__(self, folder, max_size=SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.index_path = f'{folder}/index'
+        self.entries = OrderedDict()  # chunk -> bytes, least recently used first
+        self.used = 0
+        self.changes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    def get_path(self, chunk_name):
+        return f'{self.folder}/{chunk_name}{self.SUFFIX}'
+
+    def load(self):
+        # the saved index gives the order, files cached after the last save join as the least recently used
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            with open(self.index_path, 'rb') as file:
+                saved = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            saved = []
+        on_disk = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                elif entry.name.endswith(self.SUFFIX):
+                    on_disk[entry.name[:-len(self.SUFFIX)]] = entry.stat().st_size
+        known = set(saved)
+        for chunk_name in [name for name in on_disk if name not in known] + saved:
+            if chunk_name in on_disk:
+                self.entries[chunk_name] = on_disk[chunk_name]
+        self.used = sum(self.entries.values())
+        self.evict()
+        log.info('Chunk cache %s: %d chunks, %d bytes', self.folder, len(self.entries), self.used)
+
+    def save(self):
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(list(self.entries), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+        self.changes = 0
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.SAVE_EVERY:
+            self.save()
+
+    def get(self, chunk_name, chunk_checksum=None):
+        # the stored bytes of the chunk, None on a miss
+        if chunk_name not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            with open(self.get_path(chunk_name), 'rb') as file:
+                chunk_data = file.read()
+        except FileNotFoundError:
+            chunk_data = None
+        if chunk_data is None or chunk_checksum is not None and checksum(chunk_data) != chunk_checksum:
+            self.drop(chunk_name)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(chunk_name)
+        self.hits += 1
+        self.changed()
+        return chunk_data
+
+    def put(self, chunk_name, chunk_data):
+        if chunk_name in self.entries or len(chunk_data) > self.max_size:
+            return
+        # written aside and renamed, so a crash never leaves a torn chunk behind
+        tmp_path = f'{self.get_path(chunk_name)}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(chunk_data)
+        os.replace(tmp_path, self.get_path(chunk_name))
+        self.entries[chunk_name] = len(chunk_data)
+        self.used += len(chunk_data)
+        self.evict()
+        self.changed()
+
+    def drop(self, chunk_name):
+        size = self.entries.pop(chunk_name, None)
+        if size is None:
+            return
+        self.used -= size
+        try:
+            os.remove(self.get_path(chunk_name))
+        except FileNotFoundError:
+            pass
+        self.changed()
+
+    def evict(self):
+        while self.used > self.max_size:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self):
+        count, size = len(self.entries), self.used
+        for chunk_name in list(self.entries):
+            self.drop(chunk_name)
+        self.save()
+        return count, size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'folder': self.folder,
+            'chunks': len(self.entries),
+            'used': self.used,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups > 0 else None,
+            'evictions': self.evictions,
+        }
@@ -1,18 +1,39 @@
 import asyncio
-import base64
+import hashlib
 import json
+import logging
 import os
+import shlex
+import time
 from functools import wraps
 
 import websockets
 
+import erasure
+from cache import ChunkCache
+from codec import CODECS, decode, encode
+from metrics import configure_logging
 from node import Node
+from protocol import ChecksumError, checksum, pack_request, unpack_response
+from rpc import RpcConnection
+
+log = logging.getLogger('client')
 
 
 class Client(Node):
-    def __init__(self):
+    MAX_IN_FLIGHT = 8
+    HEDGE_AFTER = 0.05  # seconds before the next replica is asked too, until there are enough reads for the p95
+    HEDGE_SAMPLES = 20  # chunk reads needed before their p95 is the hedging deadline
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, codec='auto', cache=None):
         super().__init__()
         self.is_die = False
+        self.max_in_flight = max_in_flight
+        self.codec = codec
+        self.cache = cache  # ChunkCache of whole chunks read before, None reads everything from DataNodes
+        self.policy = None  # redundancy of the next written files, None takes the policy of the directory
+        self.corrupt_replicas = []  # (store, chunk) of replicas that failed the checksum, reported after the read
+        self.tracer.name = 'client'
 
     def server_response(func):
         @wraps(func)
@@ -22,78 +43,407 @@ class Client(Node):
         return wrapper
 
     @server_response
-    async def error(self, second_self, websocket, command):
-        await websocket.send(command)
-        response = json.loads(await websocket.recv())
+    async def error(self, second_self, master, command):
+        # quoted names may have spaces, every argument is a field of its own on the wire
+        response = await master.call(*(shlex.split(command) or ['']))
 
         if response.get('confirmation') is not None:
             answer = input('[CONFIRMATION]: ' + response['confirmation'])
-            response = await websocket.send(answer)
+            response = await master.call(*(shlex.split(answer) or ['']))
 
         return response.get('body', response.get('error'))
 
     @server_response
-    async def read(self, websocket, command):
-        filename = command.split(' ')[1]
-        await websocket.send(f'read {filename}')
-        response = json.loads(await websocket.recv())
+    async def bulk(self, master, command):
+        # 'info a b c', 'delete a b c': one batch and one round trip for all files
+        name, *filenames = shlex.split(command)
+        responses = await master.batch([(name, filename) for filename in filenames])
+        if len(responses) == 1:
+            return responses[0].get('body', responses[0].get('error'))
+        return '\n'.join(f'{filename}: {response.get("body", response.get("error"))}'
+                         for filename, response in zip(filenames, responses))
+
+    def hedge_delay(self):
+        histogram = self.metrics.histograms.get('chunk_read')
+        if histogram is None or histogram.count < self.HEDGE_SAMPLES:
+            return self.HEDGE_AFTER
+        return histogram.percentile(0.95) / 1000
+
+    async def read_replica(self, chunk, host, port, chunk_checksum, chunk_range):
+        # with 'offset length' only that part of the chunk is sent, the DataNode verifies the checksum itself
+        started = time.perf_counter()
+        with self.tracer.span(f'read {chunk}'):
+            chunk_data = unpack_response(
+                await self.pool.request(host, port, pack_request('read', chunk, *chunk_range)))
+        if len(chunk_range) == 0 and chunk_checksum is not None and checksum(chunk_data) != chunk_checksum:
+            # the DataNode may have accepted the copy without a checksum and would never flag it itself
+            self.corrupt_replicas.append((f'{host}:{port}', chunk))
+            raise ChecksumError(f'Checksum mismatch for chunk {chunk}')
+        self.metrics.observe('chunk_read', time.perf_counter() - started)
+        log.debug('receive chunk %s : %d bytes from %s:%s', chunk, len(chunk_data), host, port)
+        return chunk_data
+
+    async def read_chunk(self, chunk, replicas, chunk_checksum=None, *chunk_range):
+        # replicas come best first from the master. The next one is asked as soon as a replica fails,
+        # or as a hedge when none has answered within the p95 of chunk reads; the first good answer wins
+        remaining, pending = list(replicas), {}  # task -> (host, port)
+        try:
+            while len(remaining) > 0 or len(pending) > 0:
+                if len(remaining) > 0:
+                    host, port = remaining.pop(0)
+                    pending[asyncio.ensure_future(
+                        self.read_replica(chunk, host, port, chunk_checksum, chunk_range))] = (host, port)
+                done, _ = await asyncio.wait(list(pending), timeout=self.hedge_delay() if remaining else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    self.metrics.count('hedged_reads')
+                for task in done:
+                    host, port = pending.pop(task)
+                    try:
+                        return task.result()
+                    except (ConnectionRefusedError, websockets.ConnectionClosed):
+                        log.warning('Connection refused at %s:%s', host, port)
+                    except OSError as error:
+                        log.warning('%s at %s:%s: %s', type(error).__name__, host, port, error)
+        finally:
+            for task in pending:
+                task.cancel()
+        raise FileNotFoundError(f'No live replica for chunk {chunk}')
+
+    async def write_chunk(self, chunk_name, chunk_checksum, stores, info):
+        # the chunk is sent once, DataNodes pass it along the chain of replicas;
+        # returns (store, chunk) of the replicas that did not store it, like write_stripe
+        addresses = [f'{host}:{port}' for host, port in stores]
+        with self.tracer.span(f'write {chunk_name}'):
+            acked = await self.send_pipeline(chunk_name, chunk_checksum, addresses, info)
+        if len(acked) == 0:
+            raise ConnectionError(f'No replica stored chunk {chunk_name}')
+        log.debug('wrote a chunk %s at %s', chunk_name, ', '.join(acked))
+        return [(address, chunk_name) for address in addresses if address not in acked]
+
+    async def write_piece(self, piece_name, piece, host, port):
+        with self.tracer.span(f'write {piece_name}'):
+            unpack_response(await self.pool.request(
+                host, port, pack_request('write', piece_name, checksum(piece), payload=piece)))
+
+    async def write_stripe(self, chunk_name, stores, info, layout):
+        # k data and m parity pieces go to different stores at once, any k of them are enough to read
+        k, m = layout
+        if len(stores) != k + m:
+            raise ConnectionError(f'Chunk {chunk_name} got {len(stores)} stores for {k + m} pieces')
+        pieces = await asyncio.get_event_loop().run_in_executor(None, erasure.encode, info, k, m)
+        results = await asyncio.gather(*[self.write_piece(f'{chunk_name}.{index}', piece, host, port)
+                                         for index, (piece, (host, port)) in enumerate(zip(pieces, stores))],
+                                       return_exceptions=True)
+        lost = [(f'{host}:{port}', f'{chunk_name}.{index}')
+                for index, ((host, port), result) in enumerate(zip(stores, results))
+                if isinstance(result, BaseException)]
+        if len(lost) > m:
+            raise ConnectionError(f'Only {k + m - len(lost)} pieces of chunk {chunk_name} were stored')
+        log.debug('wrote a chunk %s as %d+%d pieces, %d lost', chunk_name, k, m, len(lost))
+        return lost
+
+    async def read_stripe(self, chunk, replicas, chunk_checksum, layout):
+        # data pieces are asked first, parity pieces only in place of the ones that failed
+        k, m = layout
+
+        async def fetch(index):
+            try:
+                return index, await self.read_chunk(f'{chunk}.{index}', replicas[index])
+            except FileNotFoundError:
+                return index, None
+
+        pieces, candidates = {}, list(range(k + m))
+        while len(pieces) < k and len(candidates) > 0:
+            batch, candidates = candidates[:k - len(pieces)], candidates[k - len(pieces):]
+            for index, piece in await asyncio.gather(*[fetch(index) for index in batch]):
+                if piece is not None:
+                    pieces[index] = piece
+        if len(pieces) < k:
+            raise FileNotFoundError(f'Only {len(pieces)} of {k} pieces of chunk {chunk} are available')
+        if max(pieces) >= k:
+            log.info('Degraded read of chunk %s from pieces %s', chunk, sorted(pieces))
+        chunk_data = await asyncio.get_event_loop().run_in_executor(None, erasure.decode, pieces, k, m)
+        if chunk_checksum is not None and checksum(chunk_data) != chunk_checksum:
+            raise FileNotFoundError(f'Checksum mismatch for chunk {chunk}')
+        return chunk_data
+
+    async def run_bounded(self, semaphore, coroutine):
+        try:
+            return await coroutine
+        finally:
+            semaphore.release()
+
+    async def report_corrupt(self, master):
+        # the master drops the replicas and makes new copies, like for corrupt reports of DataNodes
+        reports, self.corrupt_replicas = self.corrupt_replicas, []
+        if len(reports) > 0:
+            log.warning('Reporting %d corrupted replicas', len(reports))
+            await master.batch([('corrupt', store, chunk) for store, chunk in reports])
+
+    def cached(self, chunk, chunk_checksum):
+        return None if self.cache is None else self.cache.get(chunk, chunk_checksum)
+
+    async def read_whole(self, chunk, replicas, chunk_checksum, codec, raw_length, layout=None):
+        chunk_data = self.cached(chunk, chunk_checksum)
+        if chunk_data is None:
+            if layout is None:
+                chunk_data = await self.read_chunk(chunk, replicas, chunk_checksum)
+            else:
+                chunk_data = await self.read_stripe(chunk, replicas, chunk_checksum, layout)
+            if self.cache is not None:
+                self.cache.put(chunk, chunk_data)
+        # decompression runs in the thread pool, zlib releases the GIL while it works
+        return await asyncio.get_event_loop().run_in_executor(None, decode, codec, chunk_data, raw_length)
+
+    async def read_chunk_to_file(self, fd, index, chunk, replicas, chunk_checksum, codec, raw_length, layout):
+        chunk_data = await self.read_whole(chunk, replicas, chunk_checksum, codec, raw_length, layout)
+        os.pwrite(fd, chunk_data, index * self.CHUNK_SIZE)
+        return len(chunk_data)
+
+    async def read_range(self, chunk, replicas, chunk_checksum, codec, raw_length, start, stop, layout=None):
+        if layout is None and codec == 'raw' and (start, stop) != (0, self.CHUNK_SIZE):
+            # a part of a chunk is not cached, the cached whole chunk serves it though
+            chunk_data = self.cached(chunk, chunk_checksum)
+            if chunk_data is not None:
+                return memoryview(chunk_data)[start:stop]
+            return await self.read_chunk(chunk, replicas, chunk_checksum, start, stop - start)
+        # compressed and erasure coded chunks can only be decoded whole
+        chunk_data = await self.read_whole(chunk, replicas, chunk_checksum, codec, raw_length, layout)
+        return memoryview(chunk_data)[start:stop]
+
+    async def open(self, master, filename):
+        response = await master.call('size', filename)
+        if response.get('body') is None:
+            raise FileNotFoundError(response.get('error'))
+        return RemoteFile(self, master, filename, response['body'])
+
+    async def write_buffered_chunk(self, buffers, buffer, size, chunk_name, stores, codec, layout):
+        try:
+            codec, info = await asyncio.get_event_loop().run_in_executor(
+                None, encode, memoryview(buffer)[:size], codec)
+            # the checksum covers the stored bytes, so DataNodes verify them without decoding
+            chunk_checksum = checksum(info)
+            if layout is None:
+                lost = await self.write_chunk(chunk_name, chunk_checksum, stores, info)
+            else:
+                lost = await self.write_stripe(chunk_name, stores, info, layout)
+            return chunk_checksum, f'{codec}:{size}', lost
+        finally:
+            buffers.put_nowait(buffer)
+
+    def hash_chunks(self, file_path):
+        # a chunk is named by the hash of its content, so data the cluster already has is not sent again
+        hashes = []
+        buffer = bytearray(self.CHUNK_SIZE)
+        with open(file_path, 'rb') as file:
+            size = file.readinto(buffer)
+            while size > 0:
+                hashes.append(hashlib.sha256(memoryview(buffer)[:size]).hexdigest())
+                size = file.readinto(buffer)
+        return hashes
+
+    def report_throughput(self, action, filename, size, started):
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        print(f'{action} {filename}: {size} bytes in {elapsed:.3f} s, '
+              f'{size / elapsed / 2 ** 20:.2f} MB/s with window {self.max_in_flight}')
+
+    async def read_part(self, master, filename, offset, length):
+        remote_file = await self.open(master, filename)
+        remote_file.seek(offset)
+        try:
+            return await remote_file.read(length)
+        finally:
+            remote_file.close()
+
+    @server_response
+    async def read(self, master, command):
+        filename, *chunk_range = shlex.split(command)[1:]
+        # dfs paths may be absolute, the copy is saved in the local working directory
+        local_name = filename.split('/')[-1]
+        r_filename = '.'.join(local_name.split('.')[:-1]) + '-read-from-dfs.' + local_name.split('.')[-1]
+        if len(chunk_range) == 2:
+            started = time.perf_counter()
+            data = await self.read_part(master, filename, int(chunk_range[0]), int(chunk_range[1]))
+            with open(r_filename, 'wb') as file:
+                file.write(data)
+            self.report_throughput('Read', filename, len(data), started)
+            return f'Read {len(data)} bytes of {filename} from offset {chunk_range[0]} to {r_filename}'
+        response = await master.call('read', filename)
         locations = response.get('body')
-        file_data = b''
         if locations is not None:
-            for chunk, replicas in locations:
-                for replica in replicas:
-                    host, port = replica
-                    uri = f"ws://{host}:{port}"
-                    try:
-                        async with websockets.connect(uri) as data_socket:
-                            await data_socket.send(f'read {chunk}')
-                            chunk_resp = json.loads(await data_socket.recv())
-                            encoded_data = chunk_resp['body']
-                            print(f'receive chunk {chunk} : {encoded_data}')
-                            chunk_data = base64.b64decode(encoded_data)
-                            file_data += chunk_data
-                        break
-                    except ConnectionRefusedError:
-                        print(f'Connection refused at {host}:{port}')
-                    except KeyError:
-                        print(f'Key Error at {host}:{port}')
-            r_filename = '.'.join(filename.split('.')[:-1]) + '-read-from-dfs.' + filename.split('.')[-1]
+            started = time.perf_counter()
+            semaphore = asyncio.Semaphore(self.max_in_flight)
+            tasks = []
             with open(r_filename, 'wb') as file:
-                file.write(file_data)
-            print(f'Read {filename} from dfs: {file_data[:32]}')
+                # chunks land at their offsets as they arrive, only the window is kept in memory
+                file.truncate(len(locations) * self.CHUNK_SIZE)
+                for index, (chunk, replicas, chunk_checksum, codec, raw_length, _, _, layout) in enumerate(locations):
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(self.run_bounded(semaphore, self.read_chunk_to_file(
+                        file.fileno(), index, chunk, replicas, chunk_checksum, codec, raw_length, layout))))
+                # every task is finished before the file is closed, none may write into a reused fd
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                await self.report_corrupt(master)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+                file_size = sum(results)
+                file.truncate(file_size)
+            self.report_throughput('Read', filename, file_size, started)
+            print(f'Read {filename} from dfs to {r_filename}')
         else:
             return response.get('error')
 
-    @server_response
-    async def write(self, websocket, command):
-        file_path = command.split(' ')[1]
-        file_size = os.path.getsize(file_path)
+    def write_command(self, file_path, hashes):
         filename = file_path.split('/')[-1]
-        print('file size', file_size)
-
-        file = open(file_path, 'rb')
-        await websocket.send(f'write {filename} {file_size}')
-        response = json.loads(await websocket.recv())
-        chunks = response.get('body')
-        if chunks is not None:
-            for chunk_name, stores in chunks:
-                info = file.read(self.CHUNK_SIZE)
-                encoded_info = base64.b64encode(info).decode("utf-8")
-                for host, port in stores:
-                    uri = f"ws://{host}:{port}"
-                    async with websockets.connect(uri) as data_socket:
-                        await data_socket.send(f'write {chunk_name} {encoded_info}')
-                        print(f'wrote at {host}:{port} a chunk: {chunk_name}')
-            return 'success writing'
+        if len(hashes) == 0:
+            return 'write', filename, 0
+        policy = [] if self.policy is None else [self.policy]
+        return ('write', filename, os.path.getsize(file_path), ','.join(hashes), *policy)
+
+    async def upload_file(self, buffers, file_path, chunks, codec):
+        # returns the commands that report checksums, codecs and lost pieces of the file to the master
+        tasks, uploaded = [], []
+        with open(file_path, 'rb') as file:
+            for index, (chunk_name, stores, is_new, layout) in enumerate(chunks):
+                if not is_new:
+                    continue
+                buffer = await buffers.get()
+                file.seek(index * self.CHUNK_SIZE)
+                size = file.readinto(buffer)
+                tasks.append(asyncio.create_task(
+                    self.write_buffered_chunk(buffers, buffer, size, chunk_name, stores, codec, layout)))
+                uploaded.append(index)
+            # chunks the cluster already had are marked '-' for the master
+            encoded = [('-', '-', [])] * len(chunks)
+            for index, chunk_encoded in zip(uploaded, await asyncio.gather(*tasks)):
+                encoded[index] = chunk_encoded
+        log.info('Uploaded %d of %d chunks of %s, the rest are already stored', len(uploaded), len(chunks), file_path)
+        if len(encoded) == 0:
+            return []
+        # the master hands checksums and codecs out with the chunk locations on read
+        filename = file_path.split('/')[-1]
+        checksums, codecs, lost = zip(*encoded)
+        reports = [('checksums', filename, ','.join(map(str, checksums)), ','.join(codecs))]
+        # replicas and pieces that did not reach their store are dropped and made again by the name node
+        return reports + [('corrupt', store, piece) for chunk_lost in lost for store, piece in chunk_lost]
+
+    @server_response
+    async def write(self, master, command):
+        path, *codec = shlex.split(command)[1:]
+        # a codec given with the command applies to these files only
+        codec = codec[0] if len(codec) > 0 else self.codec
+        if codec != 'auto' and codec not in CODECS:
+            return f'Unknown codec {codec}, available: auto, {", ".join(CODECS)}'
+        # all files of a local directory are allocated in one batch and reported in another one
+        if os.path.isdir(path):
+            file_paths = sorted(entry.path for entry in os.scandir(path) if entry.is_file())
         else:
-            return response.get('error')
+            file_paths = [path]
+        total_size = sum(os.path.getsize(file_path) for file_path in file_paths)
+        log.debug('file size %d', total_size)
+
+        started = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        hashes = await asyncio.gather(*[loop.run_in_executor(None, self.hash_chunks, file_path)
+                                        for file_path in file_paths])
+        responses = await master.batch([self.write_command(file_path, file_hashes)
+                                        for file_path, file_hashes in zip(file_paths, hashes)])
+        # the file is read lazily into a fixed set of reused buffers, one per chunk in flight
+        buffers = asyncio.Queue()
+        for _ in range(self.max_in_flight):
+            buffers.put_nowait(bytearray(self.CHUNK_SIZE))
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        tasks, errors = [], []
+        for file_path, response in zip(file_paths, responses):
+            chunks = response.get('body')
+            if chunks is None:
+                errors.append(f'{file_path}: {response.get("error")}')
+                continue
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(
+                self.run_bounded(semaphore, self.upload_file(buffers, file_path, chunks, codec))))
+        await master.batch([report for reports in await asyncio.gather(*tasks) for report in reports])
+        self.report_throughput('Wrote', path.split('/')[-1], total_size, started)
+        if len(errors) > 0:
+            return responses[0].get('error') if len(file_paths) == 1 else '\n'.join(errors)
+        return 'success writing'
+
+    async def set_window(self, master, command):
+        self.max_in_flight = int(command.split(' ')[1])
+        return f'Transfer window is {self.max_in_flight} chunks'
+
+    async def set_policy(self, master, command):
+        policy = command.split(' ')[1]
+        if policy == 'inherit':
+            self.policy = None
+            return 'Files get the redundancy policy of their directory'
+        try:
+            layout = erasure.parse_policy(policy)
+        except ValueError:
+            return f'Unknown redundancy policy {policy}, use replicate, ec:k:m or inherit'
+        if layout is not None and not erasure.available():
+            return 'Erasure coding needs numpy'
+        self.policy = policy
+        return f'Files are written with redundancy policy {self.policy}'
+
+    async def set_codec(self, master, command):
+        codec = command.split(' ')[1]
+        if codec != 'auto' and codec not in CODECS:
+            return f'Unknown codec {codec}, available: auto, {", ".join(CODECS)}'
+        self.codec = codec
+        return f'Chunks are written with codec {self.codec}'
+
+    async def stats(self, master, command):
+        # 'stats' of the name node, 'stats host:port' of a DataNode
+        address = command.split(' ')[1:]
+        if len(address) == 0:
+            snapshot = await master.request('stats')
+        else:
+            host, port = address[0].split(':')
+            snapshot = unpack_response(await self.pool.request(host, port, pack_request('stats')))
+        return json.dumps(snapshot, indent=2)
+
+    async def set_sample_rate(self, master, command):
+        self.tracer.sample_rate = float(command.split(' ')[1])
+        return f'Tracing {self.tracer.sample_rate:.0%} of commands'
 
-    # @server_response
-    # async def delete(self, websocket, command):
-    #     filename = command.split(' ')[1]
-    #     await websocket.send(f'delete {filename}')
-    #     response = json.loads(await websocket.recv())
-    #     return response.get('body', response.get('error'))
+    async def trace(self, master, command):
+        # spans of one trace from the client, the name node and every DataNode, in order of start
+        trace_id = command.split(' ')[1]
+        spans = self.tracer.find(trace_id) + await master.request('trace', trace_id)
+        for store in await master.request('stores'):
+            host, port = store['address'].split(':')
+            try:
+                spans += unpack_response(await self.pool.request(host, port, pack_request('trace', trace_id)))
+            except (OSError, websockets.ConnectionClosed):
+                log.warning('No spans from %s:%s', host, port)
+        if len(spans) == 0:
+            return f'No spans of trace {trace_id}'
+        spans.sort(key=lambda span: span['start'])
+        parents = {span['span']: span['parent'] for span in spans}
+        first = spans[0]['start']
+        lines = []
+        for span in spans:
+            depth, parent = 0, span['parent']
+            while parent in parents:
+                depth, parent = depth + 1, parents[parent]
+            lines.append(f'{(span["start"] - first) * 1000:9.2f} ms {span["duration_ms"]:9.2f} ms  '
+                         f'{"  " * depth}{span["operation"]} @ {span["node"]}')
+        return '\n'.join(lines)
+
+    async def cache_command(self, master, command):
+        # 'cache stats', 'cache clear'
+        action = command.split(' ')[1:]
+        if self.cache is None:
+            return 'Chunk cache is off'
+        if action == ['stats']:
+            return json.dumps(self.cache.stats(), indent=2)
+        if action == ['clear']:
+            count, size = self.cache.clear()
+            return f'Removed {count} chunks, {size} bytes from the cache'
+        return 'Usage: cache stats|clear'
 
     async def shut_down(self, *args):
         self.is_die = True
@@ -102,26 +452,129 @@ class Client(Node):
     command_map = {
         'read': read,
         'write': write,
-        # 'delete': delete,
+        'info': bulk,
+        'delete': bulk,
+        'window': set_window,
+        'codec': set_codec,
+        'redundancy': set_policy,
+        'stats': stats,
+        'sample': set_sample_rate,
+        'trace': trace,
+        'cache': cache_command,
         'exit': shut_down,
     }
 
 
+class RemoteFile:
+    # a seekable read-only view of a dfs file, sequential reads fetch whole chunks ahead of the position
+    READ_AHEAD = 4  # chunks
+
+    def __init__(self, client, master, filename, size, read_ahead=READ_AHEAD):
+        self.client = client
+        self.master = master
+        self.filename = filename
+        self.size = size
+        self.read_ahead = read_ahead
+        self.position = 0
+        self.sequential_end = 0  # where the previous read stopped
+        self.locations = {}  # chunk index -> location from the master
+        self.chunks = {}  # chunk index -> task fetching the whole chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    async def locate(self, first, last):
+        missing = [index for index in range(first, last + 1) if index not in self.locations]
+        if len(missing) == 0:
+            return
+        chunk_size = self.client.CHUNK_SIZE
+        offset = missing[0] * chunk_size
+        response = await self.master.call('read', self.filename, offset, (missing[-1] + 1) * chunk_size - offset)
+        if response.get('body') is None:
+            raise FileNotFoundError(response.get('error'))
+        for index, location in enumerate(response['body'], missing[0]):
+            self.locations[index] = location
+
+    async def fetch(self, index, start=0, stop=None):
+        chunk, replicas, chunk_checksum, codec, raw_length, chunk_start, chunk_stop, layout = self.locations[index]
+        if stop is None:
+            start, stop = chunk_start, chunk_stop
+        return await self.client.read_range(chunk, replicas, chunk_checksum, codec, raw_length, start, stop, layout)
+
+    def prefetch(self, index):
+        if index not in self.chunks:
+            self.chunks[index] = asyncio.create_task(self.fetch(index))
+        return self.chunks[index]
+
+    async def read(self, size=-1):
+        chunk_size = self.client.CHUNK_SIZE
+        end = self.size if size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        first, last = self.position // chunk_size, (end - 1) // chunk_size
+        sequential = self.position == self.sequential_end
+        ahead = min(last + self.read_ahead, (self.size - 1) // chunk_size) if sequential else last
+        await self.locate(first, ahead)
+        parts = []
+        try:
+            for index in range(first, last + 1):
+                chunk_start = index * chunk_size
+                start = max(self.position, chunk_start) - chunk_start
+                stop = min(end, chunk_start + chunk_size) - chunk_start
+                if sequential or index in self.chunks:
+                    parts.append((await self.prefetch(index))[start:stop])
+                else:
+                    # a random read fetches only the bytes asked for
+                    parts.append(await self.fetch(index, start, stop))
+        finally:
+            await self.client.report_corrupt(self.master)
+        if sequential:
+            for index in [index for index in self.chunks if index < last]:
+                self.chunks.pop(index).cancel()
+            for index in range(last + 1, ahead + 1):
+                self.prefetch(index)
+        self.position = self.sequential_end = end
+        return b''.join(parts)
+
+    def close(self):
+        for task in self.chunks.values():
+            task.cancel()
+        self.chunks.clear()
+
+
 async def main():
     # port = input("Enter a node port: ")
     port = 8400
     uri = f"ws://localhost:{port}"
-    cl = Client()
+    # DFS_CACHE is the folder of the chunk cache, empty turns the cache off
+    cache_folder = os.environ.get('DFS_CACHE', os.path.expanduser('~/.cache/dfs'))
+    cl = Client(cache=ChunkCache(cache_folder) if cache_folder else None)
+    master = None
     while not cl.is_die:
         in_cmd = input('Enter a command: ')
         try:
-            async with websockets.connect(uri) as websocket:
-                command = in_cmd.split(' ')[0]
-                print(await cl.command_map.get(command, cl.error)(cl, websocket, in_cmd))
+            # one connection to the master carries all commands, reconnect if it was lost
+            if master is None or not master.open:
+                master = await RpcConnection.connect(uri)
+            command = in_cmd.split(' ')[0]
+            with cl.tracer.span(command) as span:
+                print(await cl.command_map.get(command, cl.error)(cl, master, in_cmd))
+            if span is not None:
+                print(f'trace {span[0]}')
         except Exception as err:
             print(type(err).__name__, err)
-    await websocket.close(1000, 'closed by client')
+    if master is not None:
+        await master.close()
+    await cl.pool.close()
+    if cl.cache is not None:
+        cl.cache.save()
 
 if __name__ == '__main__':
+    configure_logging('WARNING')
     client = Client()
     asyncio.get_event_loop().run_until_complete(main())
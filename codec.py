@@ -0,0 +1,56 @@
+import zlib
+
+# Chunk codecs: name -> (compress, decompress). zlib is always there, faster codecs are used when installed
+CODECS = {
+    'raw': (bytes, bytes),
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+PROBE_SIZE = 4096  # bytes of a chunk compressed to guess whether the whole chunk is worth it
+PROBE_RATIO = 0.9  # data that does not shrink below this share of its size is stored raw
+
+
+# what 'auto' compresses with: every reader has zlib, lz4 and zstd are only picked by name,
+# for clusters whose readers all have the package
+AUTO_CODEC = 'zlib'
+
+
+def compressible(data):
+    sample = bytes(data[:PROBE_SIZE])
+    return len(sample) > 0 and len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+
+def encode(data, codec):
+    # returns the codec actually used and the bytes to store; 'auto' probes the chunk first
+    if codec == 'auto':
+        codec = AUTO_CODEC if compressible(data) else 'raw'
+    if codec == 'raw':
+        return codec, data
+    encoded = CODECS[codec][0](data)
+    if len(encoded) >= len(data):
+        return 'raw', data
+    return codec, encoded
+
+
+def decode(codec, data, raw_length=None):
+    if codec not in CODECS:
+        raise ValueError(f'Codec {codec} is not available')
+    if codec == 'raw':
+        return data
+    decoded = CODECS[codec][1](data)
+    if raw_length is not None and len(decoded) != raw_length:
+        raise ValueError(f'Decoded {len(decoded)} bytes instead of {raw_length}')
+    return decoded
@@ -1,15 +1,34 @@
 import asyncio
+import base64
+import binascii
+import logging
 import os
 import sys
+import time
 from functools import wraps
 
 import websockets
 
+from metrics import configure_logging
+from storage import FileStorage, SegmentStorage
 from node import Node
+from protocol import (BATCH, BYTES, FIELD_HEADER, FRAME_HEADER, RESPONSE_HEADER, VERSION, ChecksumError, PackedFrame,
+                      checksum, pack_request, pack_response, pack_response_into, unpack_response)
+from throttle import RateLimiter
+
+log = logging.getLogger('datanode')
 
 
 class DataNode(Node):
     MAX_SPACE = 2 * 2 ** 30  # 2Gb
+    HEARTBEAT_INTERVAL = 3  # seconds
+    SCRUB_RATE = 4 * 2 ** 20  # bytes per second the scrubber may read
+    SCRUB_INTERVAL = 60 * 60  # seconds between scrubber passes
+    ERROR_ROOM = 512  # least bytes of a chunk in a batch read response, so an error response fits in its place
+    ENGINES = {
+        'file': FileStorage,
+        'segment': SegmentStorage,
+    }
 
     def _response(func):
         @wraps(func)
@@ -24,30 +43,63 @@ class DataNode(Node):
     async def __init_connection(self):
         await self.connect()
 
-    def __init__(self, net_info, master_net_info):
+    def __init__(self, net_info, master_net_info, engine='file'):
         super().__init__()
 
-        self.data = []
         self.host, self.port = net_info
         self.m_host, self.m_port = master_net_info
         # TODO for production change to "f'{os.path.abspath(os.curdir)}/{self.host}:{self.port}'"
         self.ROOT_FOLDER = f'{os.path.abspath(os.curdir)}/files/{self.host}:{self.port}'
 
-        self.fill_data()
+        self.storage = self.ENGINES[engine](self.ROOT_FOLDER)
+        self.tracer.name = f'{self.host}:{self.port}'
+        self.metrics.gauge('chunks', lambda: len(self.storage))
+        self.metrics.gauge('used_space', self.storage.used_space)
         asyncio.run(self.__init_connection())
 
     async def connect(self):
         uri = f"ws://{self.m_host}:{self.m_port}"
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(f'connect {self.host}:{self.port}')
-
-    def fill_data(self):
-        if os.path.isdir(self.ROOT_FOLDER):
-            for file in os.listdir(self.ROOT_FOLDER):
-                if os.path.isfile(os.path.join(self.ROOT_FOLDER, file)):
-                    self.data.append(file)
-        else:
-            os.mkdir(self.ROOT_FOLDER)
+        async with websockets.connect(uri, compression=None) as websocket:
+            await websocket.send(pack_request('connect', f'{self.host}:{self.port}'))
+
+    async def heartbeat(self):
+        while True:
+            free_space = self.MAX_SPACE - self.storage.used_space()
+            message = pack_request('heartbeat', f'{self.host}:{self.port}', free_space, len(self.storage), self.in_flight)
+            started = time.perf_counter()
+            try:
+                await self.pool.request(self.m_host, self.m_port, message)
+                self.metrics.observe('heartbeat_rtt', time.perf_counter() - started)
+            except (OSError, websockets.ConnectionClosed) as error:
+                log.warning('Heartbeat to master failed: %s', type(error).__name__)
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+
+    async def report_corrupt(self, chunk_name):
+        log.warning('Chunk %s is corrupted', chunk_name)
+        self.metrics.count('corrupt_chunks')
+        try:
+            await self.pool.request(self.m_host, self.m_port,
+                                    pack_request('corrupt', f'{self.host}:{self.port}', chunk_name))
+        except (OSError, websockets.ConnectionClosed) as error:
+            log.warning('Corrupt chunk report to master failed: %s', type(error).__name__)
+
+    async def scrub(self):
+        # re-verifies stored chunks in the background at a limited rate
+        loop = asyncio.get_event_loop()
+        limiter = RateLimiter(self.SCRUB_RATE, burst=self.CHUNK_SIZE)
+        buffer = memoryview(bytearray(self.CHUNK_SIZE))  # every chunk is verified in the same buffer
+        while True:
+            for chunk_name in self.storage.list():
+                await limiter.acquire(self.CHUNK_SIZE)
+                try:
+                    size = self.storage.size(chunk_name)
+                    view = buffer[:size] if size <= len(buffer) else memoryview(bytearray(size))
+                    await loop.run_in_executor(None, self.storage.read_into, chunk_name, view)
+                except ChecksumError:
+                    await self.report_corrupt(chunk_name)
+                except FileNotFoundError:
+                    pass
+            await asyncio.sleep(self.SCRUB_INTERVAL)
 
     @_response
     def ping(self):
@@ -55,52 +107,119 @@ class DataNode(Node):
 
     @_response
     def read(self, chunk_name):
-        try:
-            chunk_path = f'{self.ROOT_FOLDER}/{chunk_name}'
-            with open(chunk_path, 'r') as file:
-                return file.read()
-        except ValueError:
-            raise FileNotFoundError
+        return base64.b64encode(self.storage.read(chunk_name)).decode('utf-8')
 
     @_response
     def write(self, chunk_name, chunk_file):
         try:
-            self.data.index(chunk_name)
-        except ValueError:
-            chunk_path = f'{self.ROOT_FOLDER}/{chunk_name}'
-            with open(chunk_path, 'w') as file:
-                print('writing: ', chunk_file)
-                file.write(chunk_file)
-                self.data.append(chunk_name)
-                print(self.data)
+            self.storage.write(chunk_name, base64.b64decode(chunk_file))
+        except (ValueError, binascii.Error):
+            raise FileNotFoundError
+
+    def read_binary(self, chunk_name, *args):
+        # the chunk is read from disk straight into a pooled buffer after room for the frame headers,
+        # the response is built around it in place and sent from there
+        # optional 'offset length': the whole chunk is still read so its checksum is verified,
+        # the frame then starts right before the range and only the range goes over the network
+        *chunk_range, payload = args
+        # the range is parsed before a buffer is taken, so a malformed one can not keep the buffer lent
+        offset, count = (int(chunk_range[0]), int(chunk_range[1])) if len(chunk_range) == 2 else (0, None)
+        size = self.storage.size(chunk_name)
+        buffer = self.buffers.acquire(RESPONSE_HEADER + size)
+        try:
+            length = self.storage.read_into(chunk_name, memoryview(buffer)[RESPONSE_HEADER:RESPONSE_HEADER + size])
+        except BaseException as error:
+            self.buffers.release(buffer)
+            if isinstance(error, ChecksumError):
+                asyncio.ensure_future(self.report_corrupt(chunk_name))
+            raise
+        start = min(max(offset, 0), length)
+        end = length if count is None else min(start + max(count, 0), length)
+        return PackedFrame(pack_response_into(buffer, start, end - start))
+
+    def read_batch(self, *args):
+        # many chunks in one response: a batch frame with the response of every chunk, all read into one buffer;
+        # a chunk that can not be read gets its error response in its place
+        *chunk_names, payload = args
+        sizes = []
+        for chunk_name in chunk_names:
+            try:
+                sizes.append(self.storage.size(chunk_name))
+            except FileNotFoundError:
+                sizes.append(0)
+        buffer = self.buffers.acquire(FRAME_HEADER.size + sum(
+            FIELD_HEADER.size + max(RESPONSE_HEADER + size, self.ERROR_ROOM + len(chunk_name))
+            for chunk_name, size in zip(chunk_names, sizes)))
+        view = memoryview(buffer)
+        FRAME_HEADER.pack_into(buffer, 0, VERSION, BATCH, 0, len(chunk_names))
+        offset = FRAME_HEADER.size
+        for chunk_name, size in zip(chunk_names, sizes):
+            start = offset + FIELD_HEADER.size
+            try:
+                data = view[start + RESPONSE_HEADER:start + RESPONSE_HEADER + size]
+                frame_length = len(pack_response_into(buffer, start, self.storage.read_into(chunk_name, data)))
+            except OSError as error:
+                if isinstance(error, ChecksumError):
+                    asyncio.ensure_future(self.report_corrupt(chunk_name))
+                response = pack_response(error=error)
+                view[start:start + len(response)] = response
+                frame_length = len(response)
+            FIELD_HEADER.pack_into(buffer, offset, BYTES, frame_length)
+            offset = start + frame_length
+        return PackedFrame(view[:offset])
+
+    def write_binary(self, chunk_name, *args):
+        *chunk_checksum, payload = args
+        self.storage.write(chunk_name, payload, *[int(value) for value in chunk_checksum])
+
+    async def pipeline(self, chunk_name, chunk_checksum, *args):
+        *downstream, payload = args
+        loop = asyncio.get_event_loop()
+        # store locally and forward down the chain at the same time
+        stored, acked = await asyncio.gather(
+            loop.run_in_executor(None, self.storage.write, chunk_name, payload, int(chunk_checksum)),
+            self.send_pipeline(chunk_name, chunk_checksum, downstream, payload),
+            return_exceptions=True)
+        if isinstance(acked, BaseException):
+            acked = []
+        if isinstance(stored, BaseException) and not isinstance(stored, FileExistsError):
+            if len(acked) == 0:
+                raise stored
         else:
-            raise FileExistsError
+            acked = [f'{self.host}:{self.port}'] + acked
+        return ' '.join(acked)
 
-    @_response
-    def delete(self, chunk_name):
+    async def replicate(self, chunk_name, target):
+        # copies a stored chunk straight to another DataNode on request of the master
+        host, port = target.split(':')
         try:
-            self.data.remove(chunk_name)
-            os.remove(f'{self.ROOT_FOLDER}/{chunk_name}')
-        except ValueError:
+            chunk_data = self.storage.read(chunk_name)
+        except ChecksumError:
+            asyncio.ensure_future(self.report_corrupt(chunk_name))
+            return {'error': 'ChecksumError'}
+        except OSError as error:
+            return {'error': type(error).__name__}
+        # errors of the target come back with their own type, a copy it already has is fine
+        try:
+            request = pack_request('write', chunk_name, checksum(chunk_data), payload=chunk_data)
+            unpack_response(await self.pool.request(host, port, request))
+        except FileExistsError:
             pass
+        except (OSError, websockets.ConnectionClosed) as error:
+            return {'error': type(error).__name__}
+        return {'body': f'Replicated {chunk_name} to {target}'}
+
+    @_response
+    def delete(self, chunk_name):
+        self.storage.delete(chunk_name)
 
     @_response
     def get_free_space(self):
-        engaged_size = self.get_dir_size(self.ROOT_FOLDER)
-        return self.MAX_SPACE - engaged_size
-
-    def get_dir_size(self, directory):
-        total_sum = 0
-        for file in os.listdir(directory):
-            if os.path.isdir(file):
-                total_sum += self.get_dir_size(directory)
-            else:
-                total_sum += os.path.getsize(f'{self.ROOT_FOLDER}/{file}')
-        return total_sum
+        return self.MAX_SPACE - self.storage.used_space()
 
     @_response
     def get_data(self):
-        return self.data
+        return self.storage.list()
 
     command_map = {
         'ping': ping,
@@ -108,21 +227,36 @@ class DataNode(Node):
         'read': read,
         'write': write,
         'delete': delete,
-        'list': get_data
+        'replicate': replicate,
+        'list': get_data,
+        'stats': Node.stats,
+        'trace': Node.trace,
+    }
+
+    binary_command_map = {
+        'read': read_binary,
+        'read_batch': read_batch,
+        'write': write_binary,
+        'pipeline': pipeline,
     }
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         raise Exception('Incorrect number of arguments')
     master = sys.argv[1].split(':')
     node = sys.argv[2].split(':')
     node_host, node_port = node
+    storage_engine = sys.argv[3] if len(sys.argv) == 4 else 'file'
+    configure_logging()
 
-    data_node = DataNode(node, master)
+    data_node = DataNode(node, master, storage_engine)
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    server = websockets.serve(data_node.execute, node_host, node_port)
+    server = websockets.serve(data_node.execute, node_host, node_port, compression=None)
     asyncio.get_event_loop().run_until_complete(server)
+    asyncio.get_event_loop().create_task(data_node.heartbeat())
+    asyncio.get_event_loop().create_task(data_node.storage.maintain())
+    asyncio.get_event_loop().create_task(data_node.scrub())
     asyncio.get_event_loop().run_forever()
 
@@ -0,0 +1,123 @@
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Reed-Solomon over GF(256): a chunk is cut into k data pieces and m parity pieces,
+# any k of the k + m pieces give the chunk back
+PRIMITIVE = 0x11d
+LENGTH = struct.Struct('!I')  # the chunk length goes in front of the data, pieces are padded to the same size
+
+
+def build_tables():
+    exp, log = [0] * 512, [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= PRIMITIVE
+    for power in range(255, 512):
+        exp[power] = exp[power - 255]
+    return exp, log
+
+
+EXP, LOG = build_tables()
+
+if np is not None:
+    # MUL[a][b] = a * b, a row of it multiplies a whole piece by a constant in one lookup
+    MUL = np.array(EXP, dtype=np.uint8)[np.add.outer(LOG, LOG)]
+    MUL[0, :] = 0
+    MUL[:, 0] = 0
+
+
+def available():
+    return np is not None
+
+
+def parse_policy(spec):
+    # 'replicate' or 'ec:k:m', returns (k, m) for erasure coding and None for replication
+    if spec == 'replicate':
+        return None
+    kind, k, m = spec.split(':')
+    k, m = int(k), int(m)
+    if kind != 'ec' or k < 1 or m < 1 or k + m > 256:
+        raise ValueError(f'Unknown redundancy policy {spec}')
+    return k, m
+
+
+def gf_mul(a, b):
+    return 0 if a == 0 or b == 0 else EXP[LOG[a] + LOG[b]]
+
+
+def gf_inverse(a):
+    return EXP[255 - LOG[a]]
+
+
+def coding_matrix(k, m):
+    # identity on top of a Cauchy matrix, every k rows of it are invertible
+    parity = [[gf_inverse((k + row) ^ column) for column in range(k)] for row in range(m)]
+    return [[int(row == column) for column in range(k)] for row in range(k)] + parity
+
+
+def invert(matrix):
+    size = len(matrix)
+    rows = [row + [int(index == column) for column in range(size)] for index, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next(index for index in range(column, size) if rows[index][column] != 0)
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inverse(rows[column][column])
+        rows[column] = [gf_mul(value, scale) for value in rows[column]]
+        for index in range(size):
+            factor = rows[index][column]
+            if index != column and factor != 0:
+                rows[index] = [value ^ gf_mul(factor, pivot_value)
+                               for value, pivot_value in zip(rows[index], rows[column])]
+    return [row[size:] for row in rows]
+
+
+def combine(coefficients, shards):
+    result = np.zeros(shards.shape[1], dtype=np.uint8)
+    for coefficient, shard in zip(coefficients, shards):
+        if coefficient != 0:
+            result ^= MUL[coefficient][shard]
+    return result
+
+
+def encode(data, k, m):
+    piece_size = -(-(LENGTH.size + len(data)) // k)
+    shards = np.zeros(k * piece_size, dtype=np.uint8)
+    shards[:LENGTH.size] = np.frombuffer(LENGTH.pack(len(data)), dtype=np.uint8)
+    shards[LENGTH.size:LENGTH.size + len(data)] = np.frombuffer(data, dtype=np.uint8)
+    shards = shards.reshape(k, piece_size)
+    parity = [combine(row, shards) for row in coding_matrix(k, m)[k:]]
+    return [shard.tobytes() for shard in shards] + [shard.tobytes() for shard in parity]
+
+
+def data_shards(pieces, k, m):
+    # pieces: piece index -> bytes, at least k of them
+    if all(index in pieces for index in range(k)):
+        return np.stack([np.frombuffer(pieces[index], dtype=np.uint8) for index in range(k)])
+    indexes = sorted(pieces)[:k]
+    if len(indexes) < k:
+        raise ValueError(f'{len(indexes)} pieces are left, {k} are needed')
+    matrix = coding_matrix(k, m)
+    decoding = invert([matrix[index] for index in indexes])
+    known = np.stack([np.frombuffer(pieces[index], dtype=np.uint8) for index in indexes])
+    return np.stack([combine(row, known) for row in decoding])
+
+
+def decode(pieces, k, m):
+    shards = data_shards(pieces, k, m).reshape(-1)
+    (length,) = LENGTH.unpack(shards[:LENGTH.size].tobytes())
+    return shards[LENGTH.size:LENGTH.size + length].tobytes()
+
+
+def rebuild(pieces, k, m, indexes):
+    # pieces lost with a store are computed again from any k others
+    shards = data_shards(pieces, k, m)
+    matrix = coding_matrix(k, m)
+    return {index: (shards[index] if index < k else combine(matrix[index], shards)).tobytes() for index in indexes}
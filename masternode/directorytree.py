@@ -1,64 +1,76 @@
 class DirectoryTree:
     def __init__(self):
-        self.root = Node(parent=None, path='/')
-        self.current = self.root
+        self.next_inode = 0
+        self.inodes = {}  # inode id -> Node
+        self.paths = {}  # full path -> Node
+        self.root = self.make_node(parent=None, name='/')
+        # the working directory belongs to a client session, the tree itself has none
 
-    def is_exist(self, directory):
-        return self.root.get_child_index(directory) != -1
+    def make_node(self, parent, name):
+        node = Node(inode=self.next_inode, parent=parent, name=name)
+        self.next_inode += 1
+        self.inodes[node.inode] = node
+        self.paths[node.path] = node
+        if parent is not None:
+            parent.add_children(node)
+        return node
 
-    def put(self, path):
-        for child in self.current.children:
-            if path == child.path:
-                break
-        else:
-            node = Node(parent=self.current, path=path)
-            self.current.add_children(node)
-            return node.path
+    def is_exist(self, path, start=None):
+        try:
+            self.resolve(path, start)
+        except FileNotFoundError:
+            return False
+        return True
 
-    def remove(self, path):
-        for child in self.current.children:
-            if path == child.path:
-                self.current.children.remove(child)
-
-    def go_to_parent(self):
-        if not self.is_root():
-            self.current = self.current.parent
+    def resolve(self, path, start=None):
+        node = self.root if path.startswith('/') else start or self.root
+        for name in path.split('/'):
+            if name == '..':
+                node = node.parent or node
+            elif name != '.' and name != '':
+                node = node.get_child(name)
+                if node is None:
+                    raise FileNotFoundError(f'Error: directory {path} does not exist')
+        return node
 
-    def go_to_child(self, path):
-        ind = self.current.get_child_index(path)
-        if ind != -1:
-            self.current = self.current.children[ind]
-        else:
-            raise FileNotFoundError(f'Error: current directory does not contain {path} as a child path')
+    def put(self, name, parent=None):
+        parent = parent or self.root
+        if parent.get_child(name) is None:
+            return self.make_node(parent=parent, name=name).path
 
-    def get_current(self):
-        return self.current
+    def put_path(self, path):
+        parent_path, name = path.rsplit('/', 1)
+        return self.make_node(parent=self.paths[parent_path or '/'], name=name).path
 
-    def is_root(self):
-        return self.current == self.root
+    def remove(self, path):
+        node = self.paths.get(path)
+        if node is None or node is self.root:
+            return
+        node.parent.remove_children(node.name)
+        for sub_node in node.walk():
+            del self.inodes[sub_node.inode]
+            del self.paths[sub_node.path]
 
 
 class Node:
-    def __init__(self, parent, path, children=None):
-        if children is None:
-            children = []
+    def __init__(self, inode, parent, name):
+        self.inode = inode
         self.parent = parent
-        self.path = path if parent is None else f'/{path}' if parent.path == '/' else f'{parent.path}/{path}'
-        self.children = children
+        self.name = name
+        self.path = name if parent is None else f'/{name}' if parent.path == '/' else f'{parent.path}/{name}'
+        self.children = {}  # name -> Node
 
-    def get_child_index(self, path):
-        for index, child in enumerate(self.children):
-            if child.path.split('/')[-1] == path:
-                ind = index
-                break
-        else:
-            ind = -1
-        return ind
+    def get_child(self, name):
+        return self.children.get(name)
 
     def add_children(self, node):
-        self.children.append(node)
+        self.children[node.name] = node
+
+    def remove_children(self, name):
+        self.children.pop(name, None)
 
-    def remove_children(self, path):
-        ind = self.get_child_index(path)
-        if ind != -1:
-            self.children.remove(self.children[ind])
+    def walk(self):
+        # the node and all sub directories, deepest first
+        for child in list(self.children.values()):
+            yield from child.walk()
+        yield self
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+log = logging.getLogger('editlog')
+
+
+class EditLog:
+    # every record is [length: uint32][crc32: uint32][txid: uint64][pickled (operation, args)]
+    RECORD_HEADER = struct.Struct('!IIQ')
+    SNAPSHOT_MAGIC = b'DFSIMG1\n'
+    SNAPSHOT_HEADER = struct.Struct('!Q')  # txid of the last edit inside the snapshot
+    SYNC_INTERVAL = 0.05  # seconds between background fsync calls when no reply waits for one
+    SNAPSHOT_EVERY = 100000  # edits between snapshots
+
+    def __init__(self, meta_path):
+        self.meta_path = meta_path
+        self.log_path = f'{meta_path}/edits.log'
+        self.rolled_path = f'{meta_path}/edits.log.1'  # edits up to a snapshot being saved
+        self.snapshot_path = f'{meta_path}/fsimage'
+        self.txid = 0
+        self.snapshot_txid = 0
+        self.synced_txid = 0  # edits up to this txid are fsynced
+        self.waiters = []  # (txid, future) of replies held until their edits are fsynced
+        self.wakeup = asyncio.Event()  # set when a reply waits, the sync loop fsyncs at once
+        self.file = None
+        os.makedirs(meta_path, exist_ok=True)
+
+    def load_snapshot(self):
+        if not os.path.isfile(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, 'rb') as file:
+            if file.read(len(self.SNAPSHOT_MAGIC)) != self.SNAPSHOT_MAGIC:
+                raise ValueError(f'{self.snapshot_path} is not a master snapshot')
+            (self.snapshot_txid,) = self.SNAPSHOT_HEADER.unpack(file.read(self.SNAPSHOT_HEADER.size))
+            self.txid = self.snapshot_txid
+            return pickle.load(file)
+
+    def replay(self):
+        # yields the edits made after the snapshot, the rolled log comes first
+        for path in (self.rolled_path, self.log_path):
+            if os.path.isfile(path):
+                yield from self.replay_file(path)
+
+    def replay_file(self, path):
+        # a torn record at the tail ends the log
+        with open(path, 'rb') as file:
+            data = file.read()
+        offset = 0
+        while offset + self.RECORD_HEADER.size <= len(data):
+            length, checksum, txid = self.RECORD_HEADER.unpack_from(data, offset)
+            start = offset + self.RECORD_HEADER.size
+            record = data[start:start + length]
+            if len(record) < length or zlib.crc32(record) != checksum:
+                log.warning('Edit log %s is truncated at txid %d', path, txid)
+                break
+            offset = start + length
+            if txid > self.snapshot_txid:
+                self.txid = txid
+                yield pickle.loads(record)
+
+    def open(self):
+        self.file = open(self.log_path, 'ab')
+        self.synced_txid = self.txid
+
+    def append(self, operation, args):
+        # the record reaches the OS at once and survives a killed process, fsync makes it survive power loss
+        self.txid += 1
+        record = pickle.dumps((operation, args), protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(self.RECORD_HEADER.pack(len(record), zlib.crc32(record), self.txid) + record)
+        self.file.flush()
+        return self.txid
+
+    async def wait_synced(self, txid):
+        if txid <= self.synced_txid:
+            return
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append((txid, future))
+        self.wakeup.set()
+        await future
+
+    def synced(self, txid):
+        self.synced_txid = max(self.synced_txid, txid)
+        waiting, self.waiters = self.waiters, []
+        for waiter_txid, future in waiting:
+            if waiter_txid > self.synced_txid:
+                self.waiters.append((waiter_txid, future))
+            elif not future.done():
+                future.set_result(None)
+
+    async def group_sync(self):
+        # one fsync in a thread covers every edit appended before it, edits appended meanwhile wait for the next
+        txid = self.txid
+        if self.synced_txid < txid:
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, self.file.fileno())
+            self.synced(txid)
+
+    def sync(self):
+        if self.synced_txid < self.txid:
+            os.fsync(self.file.fileno())
+            self.synced(self.txid)
+
+    def need_snapshot(self):
+        return self.txid - self.snapshot_txid >= self.SNAPSHOT_EVERY
+
+    def start_snapshot(self):
+        # moves the log aside so edits made while the snapshot is saved go to a fresh one
+        self.sync()
+        self.file.close()
+        if os.path.isfile(self.rolled_path):
+            # left by a snapshot that failed, its edits are not in any snapshot yet
+            with open(self.rolled_path, 'ab') as rolled, open(self.log_path, 'rb') as file:
+                rolled.write(file.read())
+                rolled.flush()
+                os.fsync(rolled.fileno())
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self.rolled_path)
+        self.file = open(self.log_path, 'wb')
+        os.fsync(self.file.fileno())
+        return self.txid
+
+    def save_snapshot(self, state, txid=None):
+        # state must hold every edit up to txid; safe to call from a thread once start_snapshot returned
+        if txid is None:
+            txid = self.start_snapshot()
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(self.SNAPSHOT_MAGIC + self.SNAPSHOT_HEADER.pack(txid))
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # edits up to txid are inside the snapshot, replay skips them if the removal is lost
+        os.remove(self.rolled_path)
+        self.snapshot_txid = txid
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
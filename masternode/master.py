@@ -1,13 +1,29 @@
 import asyncio
-import json
-import os
+import logging
 import random as rm
+import sys
+import time
+from array import array
+from contextvars import ContextVar
 from functools import wraps
 
 import websockets
 
+import erasure
 from masternode.directorytree import DirectoryTree
+from masternode.editlog import EditLog
+from masternode.placement import FreeSpacePlacement
+from masternode.replication import ReplicationQueue
+from masternode.stores import Store
+from metrics import configure_logging
 from node import Node
+from protocol import ChecksumError, InvalidArgumentsError, RemoteError, checksum, pack_request, unpack_response
+from throttle import RateLimiter
+
+log = logging.getLogger('master')
+
+# txid of the last edit committed by the request being served, its reply waits until that edit is fsynced
+committed_txid = ContextVar('committed_txid', default=0)
 
 
 def split(word):
@@ -21,25 +37,45 @@ def generate_chunk_name(name_size=10):
 
 
 class Master(Node):
-    stores = []
-    dir_tree = DirectoryTree()
-    dir_to_files = {'/': []}
-    file_to_chunks = {}
-    chunk_to_replicas = {}
-
-    # TODO Delete root path, delete_all etc
-    def __init__(self, root_path):
+    PING_INTERVAL = 5  # seconds
+    PING_TIMEOUT = 3
+    MISSING_CHUNK = 255  # replica count of a chunk in a snapshot that has no replica record
+    MAX_TRANSFERS = 4  # re-replication copies running at once
+    REPLICATION_BANDWIDTH = 16 * 2 ** 20  # bytes per second of re-replication traffic
+    RETRY_DEFERRED = 10  # seconds between retries of chunks that could not be replicated
+    READ_JITTER = 0.25  # stores whose read costs are this close share the reads of a chunk
+
+    def __init__(self, meta_path, placement=None):
         super().__init__()
-        self.root_path = root_path
-        self.delete_all(root_path)
+        self.placement = placement or FreeSpacePlacement()
+        self.stores = {}  # (host, port) -> Store
+        self.dir_tree = DirectoryTree()
+        self.dir_to_files = {'/': {}}  # directory path -> {filename: file path}
+        self.file_to_chunks = {}  # file path -> chunks
+        self.file_sizes = {}  # file path -> size in bytes, missing for files written before sizes were kept
+        self.chunk_to_replicas = {}
+        self.chunk_refs = {}  # chunk -> number of file entries that use it, rebuilt from file_to_chunks
+        self.chunk_checksums = {}  # chunk -> checksum reported by the writer
+        self.chunk_codecs = {}  # chunk -> (codec, raw length), only for compressed chunks
+        self.chunk_stripes = {}  # chunk -> (k, m) for erasure coded chunks, piece i is stored as 'chunk.i'
+        self.dir_policies = {}  # directory path -> redundancy policy, sub directories inherit it
+        self.store_to_chunks = {}  # (host, port) -> chunks, the reverse of chunk_to_replicas
+        self.replication_queue = ReplicationQueue()
+        self.transfers = asyncio.Semaphore(self.MAX_TRANSFERS)
+        self.bandwidth = RateLimiter(self.REPLICATION_BANDWIDTH, burst=self.MAX_TRANSFERS * self.CHUNK_SIZE)
+        self.edit_log = EditLog(meta_path)
+        self.restore()
+        self.tracer.name = 'master'
+        self.metrics.gauge('files', lambda: len(self.file_to_chunks))
+        self.metrics.gauge('chunks', lambda: len(self.chunk_to_replicas))
+        self.metrics.gauge('under_replicated', lambda: len(self.replication_queue))
+        self.metrics.gauge('stores_alive', lambda: len(self.get_alive_stores()))
 
     def _file_not_found(func):
         @wraps(func)
         def wrapper(self, *args):
-            filename = args[0]
-            try:
-                self.dir_to_files.get(self.get_current()).index(filename)
-            except ValueError:
+            directory, filename = self.split_file_path(self.get_file_path(args[0]))
+            if filename not in self.dir_to_files.get(directory, {}):
                 raise FileNotFoundError('File does not exist')
             return func(self, *args)
 
@@ -48,12 +84,9 @@ class Master(Node):
     def _file_already_exist(func):
         @wraps(func)
         def wrapper(self, *args):
-            filename = args[0]
-            try:
-                self.dir_to_files.get(self.get_current()).index(filename)
+            directory, filename = self.split_file_path(self.get_file_path(args[0]))
+            if filename in self.dir_to_files.get(directory, {}):
                 raise FileExistsError('Already exist file with the same name')
-            except ValueError:
-                pass
             return func(self, *args)
 
         return wrapper
@@ -88,36 +121,303 @@ class Master(Node):
         return size
 
     def get_alive_stores(self):
-        return [store for store in filter(lambda store: store[2], self.stores)]
-
-    def get_stores(self):
-        alive_stores = self.get_alive_stores()
-        if len(alive_stores) < self.REPLICAS_NUM:
-            return [(host, port) for (host, port, _) in alive_stores]
-
-        stores = []
-        while len(stores) < self.REPLICAS_NUM:
-            host, port, is_alive = rm.choice(alive_stores)
-            for s_host, s_port in stores:
-                if host == s_host and port == s_port:
-                    break
-            else:
-                stores.append((host, port))
-
-        return stores
+        # stores that take new chunks and pings, unseen ones wait until they connect
+        return [store for store in self.stores.values() if store.is_connected()]
 
-    def delete_all(self, path):
-        dir_list = os.listdir(path)
-        for directory in dir_list:
-            abs_path = f'{path}/{directory}'
-            if os.path.isfile(abs_path):
-                os.remove(abs_path)
-            elif os.path.isdir(abs_path):
-                self.delete_all(abs_path)
-                os.rmdir(abs_path)
+    def get_stores(self, chunk_num=1, replicas_num=None, exclude=()):
+        candidates = [store for store in self.get_alive_stores() if store.address not in exclude]
+        return self.placement.place(candidates, chunk_num, replicas_num or self.REPLICAS_NUM, self.CHUNK_SIZE)
 
     def get_current(self):
-        return self.dir_tree.current.path
+        session = self.session
+        if session.cwd not in self.dir_tree.paths:
+            # another client removed the working directory
+            session.cwd = '/'
+        return session.cwd
+
+    def get_file_path(self, filename, directory=None):
+        # file names may be absolute or relative to the working directory of the session
+        if directory is None and '/' in filename:
+            dir_path, filename = filename.rsplit('/', 1)
+            directory = self.get_dir_path(dir_path or '/')
+        directory = directory or self.get_current()
+        return f'/{filename}' if directory == '/' else f'{directory}/{filename}'
+
+    def get_dir_path(self, directory):
+        try:
+            return self.dir_tree.resolve(directory, self.dir_tree.paths[self.get_current()]).path
+        except FileNotFoundError:
+            raise FileNotFoundError('Directory does not exist')
+
+    def split_file_path(self, file_path):
+        directory, filename = file_path.rsplit('/', 1)
+        return directory or '/', filename
+
+    def restore(self):
+        state = self.edit_log.load_snapshot()
+        if state is not None:
+            self.load_state(state)
+        edits = 0
+        for operation, args in self.edit_log.replay():
+            getattr(self, f'apply_{operation}')(*args)
+            edits += 1
+        self.edit_log.open()
+        # stores known from metadata have to show up, otherwise they die and their chunks get re-replicated
+        for host, port in self.store_to_chunks:
+            self.stores.setdefault((host, port), Store(host, port, Store.UNSEEN))
+        log.info('Restored metadata at txid %d, replayed %d edits', self.edit_log.txid, edits)
+
+    def commit(self, operation, *args):
+        # the edit goes to the log first, then it is applied to the namespace
+        committed_txid.set(self.edit_log.append(operation, args))
+        return getattr(self, f'apply_{operation}')(*args)
+
+    async def acknowledge(self):
+        # group commit: replies to requests that changed metadata wait for an fsync covering their edits
+        await self.edit_log.wait_synced(committed_txid.get())
+
+    async def checkpoint(self):
+        snapshot = None
+        while True:
+            try:
+                await asyncio.wait_for(self.edit_log.wakeup.wait(), self.edit_log.SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.edit_log.wakeup.clear()
+            try:
+                await self.edit_log.group_sync()
+                if self.edit_log.need_snapshot() and (snapshot is None or snapshot.done()):
+                    # only the shallow copies are taken on the loop, the snapshot is built and written in a
+                    # thread while heartbeats and edits go on; those edits stay in the new log
+                    tables = self.copy_tables()
+                    txid = self.edit_log.start_snapshot()
+                    snapshot = asyncio.ensure_future(self.save_snapshot(tables, txid))
+            except Exception:
+                # a failed fsync is retried on the next round, the replies waiting for it stay held
+                log.exception('Edit log sync failed')
+
+    async def save_snapshot(self, tables, txid):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.write_snapshot, tables, txid)
+            log.info('Saved snapshot at txid %d', txid)
+        except Exception:
+            # the moved log stays, the next attempt appends the current log to it
+            log.exception('Snapshot at txid %d failed', txid)
+
+    def copy_tables(self):
+        # dict copies run in C without the GIL released; replica lists are replaced, never changed in place,
+        # so the copies stay as they were at this txid
+        return {
+            'dirs': list(self.dir_tree.paths),
+            'file_to_chunks': dict(self.file_to_chunks),
+            'file_sizes': dict(self.file_sizes),
+            'chunk_to_replicas': dict(self.chunk_to_replicas),
+            'chunk_checksums': dict(self.chunk_checksums),
+            'codecs': dict(self.chunk_codecs),
+            'stripes': dict(self.chunk_stripes),
+            'policies': dict(self.dir_policies),
+        }
+
+    def write_snapshot(self, tables, txid):
+        self.edit_log.save_snapshot(self.build_state(tables), txid)
+
+    def get_state(self):
+        return self.build_state(self.copy_tables())
+
+    def build_state(self, tables):
+        stores, store_ids = [], {}
+        chunks, chunk_ids = [], {}
+        replica_counts, replicas = array('B'), array('I')
+        checksums = array('q')  # -1 when the checksum is unknown
+        chunk_checksums = tables['chunk_checksums']
+        for chunk, chunk_replicas in tables['chunk_to_replicas'].items():
+            chunk_ids[chunk] = len(chunks)
+            chunks.append(chunk)
+            checksums.append(chunk_checksums.get(chunk, -1))
+            replica_counts.append(len(chunk_replicas))
+            for store in chunk_replicas:
+                if store not in store_ids:
+                    store_ids[store] = len(stores)
+                    stores.append(store)
+                replicas.append(store_ids[store])
+        file_chunk_counts, file_chunks = array('I'), array('I')
+        file_sizes = array('q')  # -1 when the size is unknown
+        for file_path, file_chunk_list in tables['file_to_chunks'].items():
+            file_chunk_counts.append(len(file_chunk_list))
+            file_sizes.append(tables['file_sizes'].get(file_path, -1))
+            for chunk in file_chunk_list:
+                if chunk not in chunk_ids:
+                    chunk_ids[chunk] = len(chunks)
+                    chunks.append(chunk)
+                    checksums.append(-1)
+                    replica_counts.append(self.MISSING_CHUNK)
+                file_chunks.append(chunk_ids[chunk])
+        return {
+            'dirs': tables['dirs'],
+            'files': list(tables['file_to_chunks']),
+            'file_chunk_counts': file_chunk_counts,
+            'file_chunks': file_chunks,
+            'file_sizes': file_sizes,
+            'chunks': chunks,
+            'stores': stores,
+            'replica_counts': replica_counts,
+            'replicas': replicas,
+            'checksums': checksums,
+            'codecs': tables['codecs'],
+            'stripes': tables['stripes'],
+            'policies': tables['policies'],
+        }
+
+    def load_state(self, state):
+        for dir_path in state['dirs']:
+            self.apply_mk(dir_path)
+        chunks, stores, replicas = state['chunks'], state['stores'], state['replicas']
+        offset = 0
+        checksums = state.get('checksums', [-1] * len(chunks))
+        self.chunk_codecs.update(state.get('codecs', {}))
+        self.chunk_stripes.update(state.get('stripes', {}))
+        self.dir_policies.update(state.get('policies', {}))
+        for chunk, count, chunk_checksum in zip(chunks, state['replica_counts'], checksums):
+            if chunk_checksum != -1:
+                self.chunk_checksums[chunk] = chunk_checksum
+            if count != self.MISSING_CHUNK:
+                self.chunk_to_replicas[chunk] = []
+                for store_id in replicas[offset:offset + count]:
+                    self.apply_replica(chunk, stores[store_id])
+                offset += count
+        offset = 0
+        file_sizes = state.get('file_sizes', [-1] * len(state['files']))
+        for file_path, count, file_size in zip(state['files'], state['file_chunk_counts'], file_sizes):
+            self.apply_create(file_path)
+            if file_size != -1:
+                self.file_sizes[file_path] = file_size
+            self.file_to_chunks[file_path] = [chunks[chunk_id] for chunk_id in state['file_chunks'][offset:offset + count]]
+            self.add_refs(self.file_to_chunks[file_path])
+            offset += count
+
+    def apply_create(self, file_path):
+        directory, filename = self.split_file_path(file_path)
+        self.dir_to_files[directory][filename] = file_path
+        self.file_to_chunks.setdefault(file_path, [])
+
+    def apply_write(self, file_path, chunks, file_size=None):
+        self.apply_create(file_path)
+        if file_size is not None:
+            self.file_sizes[file_path] = file_size
+        self.file_to_chunks[file_path] = [chunk[0] for chunk in chunks]
+        self.add_refs(self.file_to_chunks[file_path])
+        for chunk_name, stores, *layout in chunks:
+            if len(layout) > 0:
+                self.apply_stripe(chunk_name, layout[0], stores)
+                continue
+            # chunks the master already has come with no stores and keep their replicas
+            self.chunk_to_replicas.setdefault(chunk_name, [])
+            for store in stores:
+                self.apply_replica(chunk_name, tuple(store))
+
+    def apply_stripe(self, chunk, layout, stores):
+        # every piece is kept like a chunk with a single replica
+        self.chunk_stripes[chunk] = tuple(layout)
+        for piece, store in zip(self.piece_names(chunk), stores):
+            self.chunk_to_replicas.setdefault(piece, [])
+            self.apply_replica(piece, tuple(store))
+
+    def apply_policy(self, dir_path, policy):
+        if policy == 'inherit':
+            self.dir_policies.pop(dir_path, None)
+        else:
+            self.dir_policies[dir_path] = policy
+
+    def add_refs(self, chunks):
+        for chunk in chunks:
+            self.chunk_refs[chunk] = self.chunk_refs.get(chunk, 0) + 1
+
+    def apply_replica(self, chunk, store):
+        # the list is replaced, a snapshot being built in a thread may hold the old one
+        if chunk in self.chunk_to_replicas and store not in self.chunk_to_replicas[chunk]:
+            self.chunk_to_replicas[chunk] = self.chunk_to_replicas[chunk] + [store]
+            self.store_to_chunks.setdefault(store, set()).add(chunk)
+
+    def apply_drop_replica(self, chunk, store):
+        if store in self.chunk_to_replicas.get(chunk, []):
+            self.chunk_to_replicas[chunk] = [replica for replica in self.chunk_to_replicas[chunk] if replica != store]
+        self.store_to_chunks.get(store, set()).discard(chunk)
+
+    def apply_checksums(self, file_path, checksums):
+        for chunk, chunk_checksum in zip(self.file_to_chunks.get(file_path, []), checksums):
+            # None for chunks the writer did not upload, they keep what their first writer reported
+            if chunk_checksum is not None:
+                self.chunk_checksums[chunk] = chunk_checksum
+
+    def apply_codecs(self, file_path, codecs):
+        for chunk, codec_info in zip(self.file_to_chunks.get(file_path, []), codecs):
+            if codec_info is None:
+                continue
+            codec, raw_length = codec_info
+            if codec == 'raw':
+                self.chunk_codecs.pop(chunk, None)
+            else:
+                self.chunk_codecs[chunk] = (codec, raw_length)
+
+    def apply_delete(self, file_path):
+        # returns the chunks nothing refers to anymore with their replicas, so the caller can clean up DataNodes
+        directory, filename = self.split_file_path(file_path)
+        self.dir_to_files[directory].pop(filename, None)
+        removed = []
+        self.file_sizes.pop(file_path, None)
+        for chunk in self.file_to_chunks.pop(file_path, []):
+            self.chunk_refs[chunk] = self.chunk_refs.get(chunk, 1) - 1
+            if self.chunk_refs[chunk] > 0:
+                continue
+            del self.chunk_refs[chunk]
+            self.chunk_checksums.pop(chunk, None)
+            self.chunk_codecs.pop(chunk, None)
+            for name in [chunk] + self.piece_names(chunk):
+                replicas = self.chunk_to_replicas.pop(name, [])
+                for store in replicas:
+                    self.store_to_chunks.get(store, set()).discard(name)
+                removed.append((name, replicas))
+            self.chunk_stripes.pop(chunk, None)
+        return removed
+
+    def apply_copy(self, file_path, copy_path):
+        self.apply_create(copy_path)
+        self.file_to_chunks[copy_path] = list(self.file_to_chunks.get(file_path, []))
+        if file_path in self.file_sizes:
+            self.file_sizes[copy_path] = self.file_sizes[file_path]
+        self.add_refs(self.file_to_chunks[copy_path])
+
+    def apply_move(self, file_path, move_path):
+        directory, filename = self.split_file_path(file_path)
+        self.dir_to_files[directory].pop(filename, None)
+        chunks = self.file_to_chunks.pop(file_path, [])
+        self.apply_create(move_path)
+        self.file_to_chunks[move_path] = chunks
+        if file_path in self.file_sizes:
+            self.file_sizes[move_path] = self.file_sizes.pop(file_path)
+
+    def apply_mk(self, dir_path):
+        if dir_path not in self.dir_tree.paths:
+            self.dir_tree.put_path(dir_path)
+            self.dir_to_files[dir_path] = {}
+
+    def apply_rm(self, dir_path):
+        directory = self.dir_tree.paths.get(dir_path)
+        if directory is None:
+            return []
+        removed = []
+        for sub_dir in directory.walk():
+            for file_path in list(self.dir_to_files.get(sub_dir.path, {}).values()):
+                removed += self.apply_delete(file_path)
+            self.dir_to_files.pop(sub_dir.path, None)
+            self.dir_policies.pop(sub_dir.path, None)
+        self.dir_tree.remove(dir_path)
+        return removed
+
+    def send_deletes(self, removed):
+        for chunk, replicas in removed:
+            for host, port in replicas:
+                asyncio.gather(self.send_delete(chunk, host, port))
 
     # def get_abs_path(self, filename=''):
     #     abs_path = self.root_path
@@ -129,266 +429,457 @@ class Master(Node):
     #     return abs_path
 
     async def send_delete(self, chunk, host, port):
-        uri = f'ws://{host}:{port}'
         await asyncio.sleep(2)
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(f'delete {chunk}')
+        if chunk in self.chunk_to_replicas:
+            # the same content was written again in the meantime
+            return
+        await self.pool.request(host, port, pack_request('delete', chunk))
 
     async def ask_confirmation(self, action, *params):
         uri = f'ws://{self.remote_address}'
-        async with websockets.connect(uri) as websocket:
+        async with websockets.connect(uri, compression=None) as websocket:
             await websocket.send(f'Are you sure that you want to {action} {str(*params)}')
             return await websocket.recv()
 
     async def delete_old_chunks(self, host, port):
-        uri = f'ws://{host}:{port}'
         await asyncio.sleep(3)
-        async with websockets.connect(uri) as websocket:
-            await websocket.send('list')
-            response = json.loads(await websocket.recv())
-            chunks = response.get('body', [])
+        try:
+            chunks = unpack_response(await self.pool.request(host, port, pack_request('list')))
+        except OSError:
+            return
         for ch in chunks:
+            # copies of chunks that were replicated elsewhere while the storage was dead are dropped too
             replicas = self.chunk_to_replicas.get(ch)
-            if replicas is None:
-                async with websockets.connect(uri) as websocket:
-                    await websocket.send(f'delete {ch}')
-
-    async def make_additional_replicas(self, host, port):
-        uri = f'ws://{host}:{port}'
-        for chunk, replicas in self.chunk_to_replicas.items():
-            live_replica = ()
-            contains_replica = False
-            actual_replicas = 0
-            for r_host, r_port in replicas:
-                for s_host, s_port, s_is_alive in self.stores:
-                    if r_host == host and r_port == port:
-                        contains_replica = True
-                    if r_host == s_host and r_port == s_port and not s_is_alive:
-                        break
-                else:
-                    live_replica = (r_host, r_port)
-                    actual_replicas += 1
-            if actual_replicas < self.REPLICAS_NUM and not contains_replica:
-                live_host, live_port = live_replica
-                live_uri = f'ws://{live_host}:{live_port}'
-                async with websockets.connect(live_uri) as live_socket:
-                    await live_socket.send(f'read {chunk}')
-                    response = json.loads(await live_socket.recv())
-                    chunk_data = response.get('body')
-                async with websockets.connect(uri) as websocket:
-                    await websocket.send(f'write {chunk} {chunk_data}')
+            if replicas is None or (host, port) not in replicas:
+                await self.pool.request(host, port, pack_request('delete', ch))
+
+    def get_live_replicas(self, chunk):
+        return [replica for replica in self.chunk_to_replicas.get(chunk, [])
+                if replica not in self.stores or self.stores[replica].is_alive()]
+
+    def drop_dead_replicas(self, chunk):
+        # once the chunk has its copies again the replicas on dead stores are forgotten,
+        # a dead store that comes back deletes them on connect instead of keeping the chunk over-replicated
+        live_replicas = self.get_live_replicas(chunk)
+        if len(live_replicas) < self.target_replicas(chunk):
+            return
+        for replica in self.chunk_to_replicas.get(chunk, []):
+            if replica not in live_replicas:
+                self.commit('drop_replica', chunk, replica)
+
+    def order_replicas(self, replicas):
+        # the best store to read from first: stores known to be dead are left out, alive ones go by
+        # read cost, then suspects, then stores that have not connected since the restart
+        ordered = []
+        for replica in replicas:
+            store = self.stores.get(replica)
+            if store is None or not store.is_alive():
+                continue
+            if store.state == Store.UNSEEN:
+                ordered.append(((2, 0), replica))
+            else:
+                cost = store.read_cost() * rm.uniform(1, 1 + self.READ_JITTER)
+                ordered.append(((0 if store.state == Store.ALIVE else 1, cost), replica))
+        return [replica for _, replica in sorted(ordered)]
+
+    def piece_names(self, chunk):
+        k, m = self.chunk_stripes.get(chunk, (0, 0))
+        return [f'{chunk}.{index}' for index in range(k + m)]
+
+    def stripe_of(self, piece):
+        chunk, _, index = piece.rpartition('.')
+        if chunk in self.chunk_stripes:
+            return chunk, int(index)
+        return None, None
+
+    def target_replicas(self, chunk):
+        return self.REPLICAS_NUM if self.stripe_of(chunk)[0] is None else 1
+
+    def redundancy(self, chunk):
+        # how many more losses the chunk survives, plus one: the replication queue serves the lowest first
+        stripe, _ = self.stripe_of(chunk)
+        if stripe is None:
+            return len(self.get_live_replicas(chunk))
+        k, m = self.chunk_stripes[stripe]
+        return sum(1 for piece in self.piece_names(stripe) if len(self.get_live_replicas(piece)) > 0) - k + 1
+
+    def get_policy(self, dir_path):
+        while dir_path not in self.dir_policies and dir_path != '/':
+            dir_path = dir_path.rsplit('/', 1)[0] or '/'
+        return self.dir_policies.get(dir_path, 'replicate')
+
+    def enqueue_replication(self, chunks):
+        for chunk in chunks:
+            if len(self.get_live_replicas(chunk)) < self.target_replicas(chunk):
+                self.replication_queue.push(chunk, self.redundancy(chunk))
+
+    async def replicate(self):
+        retried = time.monotonic()
+        while True:
+            chunk = self.replication_queue.pop()
+            if chunk is None:
+                if time.monotonic() - retried > self.RETRY_DEFERRED:
+                    self.replication_queue.retry_deferred(self.redundancy)
+                    retried = time.monotonic()
+                await asyncio.sleep(1)
+                continue
+            await self.transfers.acquire()
+            asyncio.ensure_future(self.replicate_chunk(chunk))
+
+    async def replicate_chunk(self, chunk):
+        try:
+            if self.stripe_of(chunk)[0] is not None:
+                await self.rebuild_piece(chunk)
+                return
+            live_replicas = self.get_live_replicas(chunk)
+            missing = self.REPLICAS_NUM - len(live_replicas)
+            if missing <= 0 or chunk not in self.chunk_to_replicas:
+                return
+            if len(live_replicas) == 0:
+                log.error('Chunk %s lost all replicas', chunk)
+                return
+            [targets] = self.get_stores(replicas_num=missing, exclude=self.chunk_to_replicas[chunk])
+            if len(targets) == 0:
+                self.replication_queue.defer(chunk)
+                return
+            source_host, source_port = rm.choice(live_replicas)
+            for target_host, target_port in targets:
+                await self.bandwidth.acquire(self.CHUNK_SIZE)
+                # the source DataNode pushes the chunk straight to the target
+                try:
+                    unpack_response(await self.pool.request(
+                        source_host, source_port, pack_request('replicate', chunk, f'{target_host}:{target_port}')))
+                except (FileNotFoundError, RemoteError, ChecksumError):
+                    # the chunk may be not uploaded yet, try again later
+                    self.replication_queue.defer(chunk)
+                    continue
+                if chunk in self.chunk_to_replicas:
+                    self.commit('replica', chunk, (target_host, target_port))
+                    log.info('Replicated %s from %s:%s to %s:%s',
+                             chunk, source_host, source_port, target_host, target_port)
+            self.drop_dead_replicas(chunk)
+        except (OSError, websockets.ConnectionClosed) as error:
+            log.warning('Replication of %s failed: %s', chunk, type(error).__name__)
+            self.replication_queue.defer(chunk)
+        finally:
+            self.transfers.release()
+
+    async def rebuild_piece(self, piece):
+        # a lost piece of an erasure coded chunk is computed from k others and written to a new store
+        chunk, index = self.stripe_of(piece)
+        k, m = self.chunk_stripes[chunk]
+        if len(self.get_live_replicas(piece)) > 0:
+            return
+        pieces, holders = {}, []
+        for other_index, other_piece in enumerate(self.piece_names(chunk)):
+            live_replicas = self.get_live_replicas(other_piece)
+            holders += live_replicas
+            if other_index == index or len(live_replicas) == 0 or len(pieces) == k:
+                continue
+            host, port = live_replicas[0]
+            try:
+                pieces[other_index] = unpack_response(
+                    await self.pool.request(host, port, pack_request('read', other_piece)))
+            except (OSError, websockets.ConnectionClosed):
+                pass
+        if len(pieces) < k:
+            log.error('Chunk %s has %d pieces left, %d are needed', chunk, len(pieces), k)
+            self.replication_queue.defer(piece)
+            return
+        await self.bandwidth.acquire(sum(len(data) for data in pieces.values()))
+        rebuilt = await asyncio.get_event_loop().run_in_executor(None, erasure.rebuild, pieces, k, m, [index])
+        data = rebuilt[index]
+        # another store of the same stripe is used only when there is no other choice
+        [targets] = self.get_stores(replicas_num=1, exclude=holders)
+        if len(targets) == 0:
+            [targets] = self.get_stores(replicas_num=1, exclude=self.chunk_to_replicas[piece])
+        if len(targets) == 0:
+            self.replication_queue.defer(piece)
+            return
+        target_host, target_port = targets[0]
+        try:
+            unpack_response(await self.pool.request(
+                target_host, target_port, pack_request('write', piece, checksum(data), payload=data)))
+        except FileExistsError:
+            pass
+        except (OSError, websockets.ConnectionClosed):
+            self.replication_queue.defer(piece)
+            return
+        if piece in self.chunk_to_replicas:
+            self.commit('replica', piece, (target_host, target_port))
+            log.info('Rebuilt %s from %d pieces at %s:%s', piece, len(pieces), target_host, target_port)
+            self.drop_dead_replicas(piece)
 
     @_response
     def connect(self, storage_net_info):
         storage_host, storage_port = storage_net_info.split(':')
-        for storage in self.stores:
-            host, port, is_alive = storage
-            if host == storage_host and port == storage_port:
-                ind = self.stores.index(storage)
-                self.stores[ind] = (host, port, True)
-                print(f'Reconnect to storage: {storage_host}:{storage_port}')
-                asyncio.gather(self.delete_old_chunks(host, port), self.make_additional_replicas(host, port))
-                break
+        store = self.stores.get((storage_host, storage_port))
+        if store is not None:
+            store.seen()
+            log.info('Reconnect to storage: %s:%s', storage_host, storage_port)
         else:
-            self.stores.append((storage_host, storage_port, True))
-            asyncio.gather(self.make_additional_replicas(storage_host, storage_port))
-            print(f'Connect to storage: {storage_host}:{storage_port}')
+            self.stores[(storage_host, storage_port)] = Store(storage_host, storage_port)
+            log.info('Connect to storage: %s:%s', storage_host, storage_port)
+        # metadata survives restarts, so a storage may still hold chunks deleted meanwhile
+        asyncio.gather(self.delete_old_chunks(storage_host, storage_port))
+        self.replication_queue.retry_deferred(self.redundancy)
         return 'Success connect'
 
+    @_response
+    def heartbeat(self, storage_net_info, free_space, chunk_count, load):
+        storage_host, storage_port = storage_net_info.split(':')
+        store = self.stores.get((storage_host, storage_port))
+        if store is None or not store.is_connected():
+            self.connect(storage_net_info)
+            store = self.stores[(storage_host, storage_port)]
+        store.heartbeat(int(free_space), int(chunk_count), int(load))
+
+    @_response
+    def list_stores(self):
+        return [store.to_dict() for store in self.stores.values()]
+
     async def ping_store(self, store):
-        host, port, is_alive = store
-        uri = f"ws://{host}:{port}"
-        if is_alive:
-            try:
-                async with websockets.connect(uri) as websocket:
-                    await websocket.send('ping')
-                    await asyncio.wait_for(websocket.recv(), 3)
-            except ConnectionRefusedError:
-                print(f'Storage {host}:{port} died. We regret :(')
-                ind = self.stores.index(store)
-                self.stores[ind] = (host, port, False)
-            except asyncio.TimeoutError:
-                print(f'Storage {host}:{port} died. We regret :(')
-                ind = self.stores.index(store)
-                self.stores[ind] = (host, port, False)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.pool.request(store.host, store.port, pack_request('ping')), self.PING_TIMEOUT)
+            rtt = time.perf_counter() - started
+            store.record_rtt(rtt)
+            self.metrics.observe('ping_rtt', rtt)
+        except (OSError, websockets.ConnectionClosed, asyncio.TimeoutError):
+            log.warning('Storage %s:%s does not answer a ping', store.host, store.port)
 
     async def ping(self):
         while True:
-            if len(self.stores) == 0:
-                await asyncio.sleep(5)
-                continue
-            for store in self.stores:
-                await self.ping_store(store)
-            await asyncio.sleep(5)
+            # all stores are pinged at once, so a slow store does not delay the others
+            await asyncio.gather(*[self.ping_store(store) for store in self.get_alive_stores()])
+            now = time.monotonic()
+            for store in self.stores.values():
+                if store.check(now):
+                    log.warning('Storage %s:%s died. We regret :(', store.host, store.port)
+                    self.enqueue_replication(self.store_to_chunks.get(store.address, ()))
+            await asyncio.sleep(self.PING_INTERVAL)
 
     @_response
     def create(self, filename):
-        self.dir_to_files[self.dir_tree.current.path].append(filename)
-        print(f'created empty file: {filename}')
+        self.commit('create', self.get_file_path(filename))
+        log.debug('created empty file: %s', filename)
 
     @_response
     @_file_not_found
-    def read(self, filename):
+    def read(self, filename, offset=0, length=None):
+        # only the chunks covering [offset, offset + length) with the range inside each of them
+        file_path = self.get_file_path(filename)
+        chunks = self.file_to_chunks.get(file_path, [])
+        offset, end = int(offset), self.get_file_size(file_path)
+        if offset < 0 or (length is not None and int(length) < 0):
+            # a negative chunk index would hand out the end of the file
+            raise InvalidArgumentsError(f'Offset and length can not be negative: {offset} {length}')
+        if length is not None:
+            end = min(offset + int(length), end)
         chunks_locations = []
-        chunks = self.file_to_chunks.get(filename, [])
-        for chunk in chunks:
-            replicas = [replica for replica in self.chunk_to_replicas[chunk]]
-            chunks_locations.append((chunk, replicas))
+        last_index = min(len(chunks), (end + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE)
+        for index in range(offset // self.CHUNK_SIZE, last_index):
+            chunk = chunks[index]
+            chunk_start = index * self.CHUNK_SIZE
+            replicas = self.order_replicas(self.chunk_to_replicas.get(chunk, []))
+            layout = self.chunk_stripes.get(chunk)
+            if layout is not None:
+                # the stores of every piece in piece order
+                replicas = [self.order_replicas(self.chunk_to_replicas.get(piece, []))
+                            for piece in self.piece_names(chunk)]
+            codec, raw_length = self.chunk_codecs.get(chunk, ('raw', None))
+            start, stop = max(offset, chunk_start), min(end, chunk_start + self.CHUNK_SIZE)
+            chunks_locations.append((chunk, replicas, self.chunk_checksums.get(chunk), codec, raw_length,
+                                     start - chunk_start, stop - chunk_start, layout))
         return chunks_locations
 
+    def get_file_size(self, file_path):
+        # files written before sizes were kept are counted as full chunks
+        return self.file_sizes.get(file_path, len(self.file_to_chunks.get(file_path, [])) * self.CHUNK_SIZE)
+
     @_response
-    @_file_already_exist
-    def write(self, filename, file_size):
-        self.dir_to_files[self.get_current()].append(filename)
-        self.file_to_chunks[filename] = []
+    @_file_not_found
+    def size(self, filename):
+        return self.get_file_size(self.get_file_path(filename))
 
+    @_response
+    @_file_already_exist
+    def write(self, filename, file_size, hashes=None, policy=None):
+        layout = self.parse_policy(policy or self.get_policy(self.split_file_path(self.get_file_path(filename))[0]))
         quotient = int(file_size) // self.CHUNK_SIZE
         chunk_num = quotient if int(file_size) % self.CHUNK_SIZE == 0 else quotient + 1
-        print(chunk_num)
-        chunks = []
-        for i in range(chunk_num):
-            chunk_name = generate_chunk_name()
-            stores = self.get_stores()
-            self.file_to_chunks[filename].append(chunk_name)
-            self.chunk_to_replicas[chunk_name] = []
-            for store in stores:
-                self.chunk_to_replicas[chunk_name].append(store)
-            chunks.append((chunk_name, stores))
-        return chunks
+        if hashes is None:
+            chunk_names = [generate_chunk_name() for _ in range(chunk_num)]
+        else:
+            # content-addressed chunks: only hashes the cluster does not hold yet are uploaded
+            chunk_names = hashes.split(',')
+        new_chunks = list(dict.fromkeys(name for name in chunk_names if not self.is_stored(name)))
+        if layout is None:
+            placements = dict(zip(new_chunks, self.get_stores(len(new_chunks))))
+        else:
+            placements = dict(zip(new_chunks, self.get_stripe_stores(len(new_chunks), sum(layout))))
+        chunks = [(chunk_name, placements.pop(chunk_name, None)) for chunk_name in chunk_names]
+        self.commit('write', self.get_file_path(filename),
+                    [(chunk_name, stores or []) if stores is None or layout is None else (chunk_name, stores, layout)
+                     for chunk_name, stores in chunks], int(file_size))
+        if layout is None:
+            # with fewer live stores than replicas the missing copies are made later
+            self.enqueue_replication([chunk_name for chunk_name, stores in chunks
+                                      if stores is not None and len(stores) < self.REPLICAS_NUM])
+        return [(chunk_name, stores or [], stores is not None, layout) for chunk_name, stores in chunks]
+
+    def is_stored(self, chunk):
+        # replicas are recorded when the chunk is allocated, its checksum only after the upload, so a chunk
+        # another writer is still uploading or failed to upload is uploaded again
+        if chunk not in self.chunk_checksums:
+            return False
+        if chunk in self.chunk_stripes:
+            k, _ = self.chunk_stripes[chunk]
+            return sum(1 for piece in self.piece_names(chunk) if len(self.get_live_replicas(piece)) > 0) >= k
+        return len(self.get_live_replicas(chunk)) > 0
+
+    def get_stripe_stores(self, chunk_num, width):
+        # every piece of a stripe goes to a store of its own, so losing a store loses one piece
+        placements = self.get_stores(chunk_num, replicas_num=width) if chunk_num > 0 else []
+        if len(placements) < chunk_num or any(len(stores) < width for stores in placements):
+            raise OSError(f'Erasure coding needs {width} alive stores with free space')
+        return placements
+
+    def parse_policy(self, policy):
+        try:
+            layout = erasure.parse_policy(policy)
+        except ValueError:
+            raise OSError(f'Unknown redundancy policy {policy}, use replicate or ec:k:m')
+        if layout is not None and not erasure.available():
+            raise OSError('Erasure coding needs numpy on the name node')
+        return layout
+
+    @_response
+    def policy(self, policy=None, directory=None):
+        directory = self.get_current() if directory is None else self.get_dir_path(directory)
+        if policy is not None:
+            if policy != 'inherit':
+                self.parse_policy(policy)
+            self.commit('policy', directory, policy)
+        return f'Redundancy policy of {directory} is {self.get_policy(directory)}'
+
+    @_response
+    @_file_not_found
+    def set_checksums(self, filename, checksums, codecs=None):
+        file_path = self.get_file_path(filename)
+        # '-' marks a chunk the client did not upload
+        self.commit('checksums', file_path, [None if value == '-' else int(value) for value in checksums.split(',')])
+        if codecs is not None:
+            # 'codec:raw length' per chunk, as the client encoded it
+            codecs = [None if codec == '-' else codec.split(':') for codec in codecs.split(',')]
+            self.commit('codecs', file_path, [None if codec is None else (codec[0], int(codec[1]))
+                                              for codec in codecs])
+
+    @_response
+    def corrupt(self, storage_net_info, chunk):
+        # a DataNode found a broken replica: forget it, remove it and make a new copy
+        storage_host, storage_port = storage_net_info.split(':')
+        store = (storage_host, storage_port)
+        if store in self.chunk_to_replicas.get(chunk, []):
+            self.commit('drop_replica', chunk, store)
+            asyncio.gather(self.drop_corrupt(chunk, storage_host, storage_port))
+            log.warning('Replica of %s at %s is corrupted', chunk, storage_net_info)
+
+    async def drop_corrupt(self, chunk, host, port):
+        # the broken copy goes away before a new one is scheduled, so the store can get a clean copy
+        try:
+            await self.pool.request(host, port, pack_request('delete', chunk))
+        except (OSError, websockets.ConnectionClosed) as error:
+            log.warning('Delete of corrupted %s at %s:%s failed: %s', chunk, host, port, type(error).__name__)
+        self.enqueue_replication([chunk])
 
     @_response
     @_file_not_found
     def info(self, filename):
-        chunks = self.file_to_chunks.get(filename, [])
+        chunks = self.file_to_chunks.get(self.get_file_path(filename), [])
         size = self.convert_to_size(len(chunks))
-        return f'File took {size}. Distribute in {len(chunks)} chunks'
+        shared = sum(1 for chunk in chunks if self.chunk_refs.get(chunk, 0) > 1)
+        return f'File took {size}. Distribute in {len(chunks)} chunks, {shared} shared with other files'
 
     @_response
     @_file_not_found
     def delete(self, filename):
-        chunks = self.file_to_chunks.get(filename, [])
-        for chunk in chunks:
-            for host, port in self.chunk_to_replicas[chunk]:
-                asyncio.gather(self.send_delete(chunk, host, port))
-            del self.chunk_to_replicas[chunk]
-        del self.file_to_chunks[filename]
-        self.dir_to_files[self.get_current()].remove(filename)
-        print(f'Delete file: {filename}')
+        self.send_deletes(self.commit('delete', self.get_file_path(filename)))
+        log.debug('Delete file: %s', filename)
         return f'File deleted: {filename}'
 
     @_response
     @_file_not_found
     def copy(self, filename, copy_dir):
-        copy_full_path = copy_dir
-        for dir_path in list(self.dir_to_files):
-            if dir_path.split('/')[-1] == copy_dir:
-                copy_full_path = dir_path
-        files_in_copy_dir = self.dir_to_files.get(copy_full_path)
+        copy_full_path = self.get_dir_path(copy_dir)
+        file_path = self.get_file_path(filename)
+        name = self.split_file_path(file_path)[1]
 
-        if files_in_copy_dir is None:
-            raise FileNotFoundError('Directory does not exist')
-
-        if filename in files_in_copy_dir:
+        if name in self.dir_to_files[copy_full_path]:
             raise FileExistsError('File already exist in this directory')
         else:
-            files_in_copy_dir.append(filename)
+            self.commit('copy', file_path, self.get_file_path(name, copy_full_path))
             return f'File copied: {filename}'
 
     @_response
     @_file_not_found
     def move(self, filename, move_dir):
-        move_full_path = move_dir
-        for dir_path in list(self.dir_to_files):
-            if dir_path.split('/')[-1] == move_dir:
-                move_full_path = dir_path
-        files_in_move_dir = self.dir_to_files.get(move_full_path)
+        move_full_path = self.get_dir_path(move_dir)
+        file_path = self.get_file_path(filename)
+        name = self.split_file_path(file_path)[1]
 
-        if files_in_move_dir is None:
-            raise FileNotFoundError('Directory does not exist')
-
-        if filename in files_in_move_dir:
+        if name in self.dir_to_files[move_full_path]:
             raise FileExistsError('File already exist in this directory')
         else:
-            files_in_move_dir.append(filename)
-            self.dir_to_files[self.get_current()].remove(filename)
+            self.commit('move', file_path, self.get_file_path(name, move_full_path))
             return f'File moved: {filename} to {move_dir}'
 
     @_response
     def open_dir(self, new_path):
-        paths = new_path.split('/')
+        # only the session of this connection moves
         try:
-            for path in paths:
-                if path == '..':
-                    self.dir_tree.go_to_parent()
-                elif path != '.' and path != '':
-                    self.dir_tree.go_to_child(path)
+            self.session.cwd = self.get_dir_path(new_path)
         except FileNotFoundError:
             return 'This directory does not exist'
-        print('Opened dir. New current dir is ', self.dir_tree.current.path)
-        return f'Open directory. Current directory is {self.dir_tree.current.path}'
+        return f'Open directory. Current directory is {self.session.cwd}'
 
     @_response
-    def list_dir(self, flag=''):
-        current_dir = self.dir_tree.current.path
-        print('current dir: ', current_dir)
-        files = self.dir_to_files.get(current_dir, [])
-        print('current', current_dir, 'files', files, 'directories', [ch.path for ch in self.dir_tree.current.children])
-        if flag == '-a':
-            return files + [f'/{ch.path.split("/")[-1]}' for ch in self.dir_tree.current.children]
+    def list_dir(self, *args):
+        # ls [directory] [-a]
+        paths = [arg for arg in args if arg != '-a']
+        directory = self.get_dir_path(paths[0]) if len(paths) > 0 else self.get_current()
+        files = list(self.dir_to_files.get(directory, {}))
+        if '-a' in args:
+            return files + [f'/{name}' for name in self.dir_tree.paths[directory].children]
         return files
 
     @_response
     def make_dir(self, dir_name):
-        already_have = dir_name in [ch.path.split('/')[-1] for ch in self.dir_tree.current.children]
-        if not already_have:
-            full_path = self.dir_tree.put(dir_name)
-            self.dir_to_files[full_path] = []
-            print('Made directory:', dir_name)
+        dir_path = self.get_file_path(dir_name)
+        if dir_path not in self.dir_tree.paths:
+            self.commit('mk', dir_path)
+            log.debug('Made directory: %s', dir_name)
             return f'Made directory: {dir_name}'
         else:
-            print('Directory already exist')
+            log.debug('Directory already exist')
             return f'Directory already exist'
 
-    async def _delete_dir(self, dir_name, recursive=False):
-        children = self.dir_tree.current.children
-        for index, name in enumerate([ch.path.split('/')[-1] for ch in children]):
-            if name == dir_name:
-                dir_index = index
-                dir_full_name = children[index].path
-                break
-        else:
-            raise FileNotFoundError('Directory does not exist')
-
-        has_files = True
-        # has_files = len(self.dir_to_files[dir_full_name]) > 0
-        has_sub_dirs = len(children[dir_index].children) > 0
-        if not recursive and (has_files or has_sub_dirs):
-            # TODO fix confirmation
-            # answer = asyncio.gather(self.ask_confirmation('delete', dir_name), asyncio.get_event_loop())
-            # answer = str(answer).lower()
-            # print('answer: ', answer)
-            # if answer == 'yes' or answer == 'y' or answer == '':
-            file_list = self.dir_to_files.get(dir_full_name, [])
-            sub_dirs_list = [ch.path.split('/')[-1] for ch in children]
-            for sub_dir in sub_dirs_list:
-                self.delete_dir(sub_dir, recursive=True)
-            for filename in file_list:
-                self.delete(filename)
-            # else:
-            #     return 'Canceled deleting'
-        del self.dir_to_files[dir_full_name]
-        self.dir_tree.remove(dir_full_name)
-        if not recursive:
-            return f'Success delete directory: {dir_name}'
-
     @_response
-    def delete_dir(self, dir_name, recursive=False):
-        asyncio.gather(self._delete_dir(dir_name, recursive))
+    def delete_dir(self, dir_name):
+        # the directory goes with all its files and sub directories, without asking
+        dir_path = self.get_dir_path(dir_name)
+        if dir_path == '/':
+            raise PermissionError('The root directory can not be removed')
+        self.send_deletes(self.commit('rm', dir_path))
+        return f'Success delete directory: {dir_name}'
 
     command_map = {
         'connect': connect,
+        'heartbeat': heartbeat,
+        'stores': list_stores,
         'create': create,
         'read': read,
+        'size': size,
         'write': write,
         'delete': delete,
         'info': info,
@@ -397,27 +888,35 @@ class Master(Node):
         'cd': open_dir,
         'ls': list_dir,
         'mk': make_dir,
-        'rm': delete_dir
+        'rm': delete_dir,
+        'checksums': set_checksums,
+        'corrupt': corrupt,
+        'policy': policy,
+        'stats': Node.stats,
+        'trace': Node.trace,
     }
 
 
 if __name__ == '__main__':
-    master_port = 8400
+    # master.py [port] [metadata folder]
+    configure_logging()
+    master_port = int(sys.argv[1]) if len(sys.argv) > 1 else 8400
 
-    master = Master('../datanode/files')
-    # master = Master()
+    master = Master(sys.argv[2] if len(sys.argv) > 2 else 'metadata')
     is_not_hosted = True
 
     loop = asyncio.get_event_loop()
     asyncio.run_coroutine_threadsafe(master.ping(), loop)
+    asyncio.run_coroutine_threadsafe(master.checkpoint(), loop)
+    asyncio.run_coroutine_threadsafe(master.replicate(), loop)
 
     while is_not_hosted:
         try:
-            server = websockets.serve(master.execute, "localhost", master_port)
+            server = websockets.serve(master.execute, "localhost", master_port, max_size=None, compression=None)
             loop.run_until_complete(server)
-            print('masternode hosted at localhost:', master_port)
+            log.info('masternode hosted at localhost: %d', master_port)
             loop.run_forever()
             is_not_hosted = False
         except OSError as e:
-            print(e)
+            log.error('%s', e)
             master_port += 1
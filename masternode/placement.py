@@ -0,0 +1,65 @@
+import math
+import random as rm
+from abc import ABC, abstractmethod
+
+
+class Placement(ABC):
+    # picks distinct stores for every chunk of a write in one call
+
+    @abstractmethod
+    def place(self, stores, chunk_num, replicas_num, chunk_size):
+        pass
+
+    def usable(self, stores, chunk_size):
+        return [store for store in stores if store.free_space is None or store.free_space >= chunk_size]
+
+
+class RandomPlacement(Placement):
+    def place(self, stores, chunk_num, replicas_num, chunk_size):
+        addresses = [store.address for store in self.usable(stores, chunk_size)]
+        count = min(replicas_num, len(addresses))
+        return [rm.sample(addresses, count) for _ in range(chunk_num)]
+
+
+class FreeSpacePlacement(Placement):
+    # weighted random by free space, sampled without replacement with keys log(u) / weight
+    # (the top keys of u ** (1 / weight)), so a store is never picked twice and no draw is thrown away
+    def place(self, stores, chunk_num, replicas_num, chunk_size):
+        stores = self.usable(stores, chunk_size)
+        known = [store.free_space for store in stores if store.free_space is not None]
+        default_space = sum(known) / len(known) if len(known) > 0 else 1
+        free = {store.address: store.free_space if store.free_space is not None else default_space
+                for store in stores}
+        count = min(replicas_num, len(free))
+        placements = []
+        for _ in range(chunk_num):
+            keys = [(math.log(1 - rm.random()) / max(space, 1), address) for address, space in free.items()]
+            chosen = [address for _, address in sorted(keys, reverse=True)[:count]]
+            for address in chosen:
+                # space taken by earlier chunks of the same write counts for the next ones
+                free[address] -= chunk_size
+            placements.append(chosen)
+        return placements
+
+
+class PowerOfTwoChoicesPlacement(Placement):
+    # every replica goes to the less loaded of two random stores
+    def place(self, stores, chunk_num, replicas_num, chunk_size):
+        stores = self.usable(stores, chunk_size)
+        depth = {store.address: store.load for store in stores}
+        count = min(replicas_num, len(depth))
+        placements = []
+        for _ in range(chunk_num):
+            candidates = list(depth)
+            chosen = []
+            for _ in range(count):
+                if len(candidates) == 1:
+                    address = candidates[0]
+                else:
+                    first, second = rm.sample(candidates, 2)
+                    address = first if depth[first] <= depth[second] else second
+                candidates.remove(address)
+                depth[address] += 1
+                chosen.append(address)
+            placements.append(chosen)
+        return placements
@@ -0,0 +1,34 @@
+import heapq
+import itertools
+
+
+class ReplicationQueue:
+    # chunks with the fewest live replicas come out first
+    def __init__(self):
+        self.heap = []
+        self.queued = set()
+        self.deferred = set()  # chunks without a store to copy to, retried when a store connects
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.queued) + len(self.deferred)
+
+    def push(self, chunk, live_replicas):
+        if chunk not in self.queued:
+            self.queued.add(chunk)
+            heapq.heappush(self.heap, (live_replicas, next(self.counter), chunk))
+
+    def pop(self):
+        if len(self.heap) == 0:
+            return None
+        _, _, chunk = heapq.heappop(self.heap)
+        self.queued.discard(chunk)
+        return chunk
+
+    def defer(self, chunk):
+        self.deferred.add(chunk)
+
+    def retry_deferred(self, live_replicas):
+        deferred, self.deferred = self.deferred, set()
+        for chunk in deferred:
+            self.push(chunk, live_replicas(chunk))
@@ -0,0 +1,74 @@
+import time
+
+
+class Store:
+    ALIVE = 'alive'
+    SUSPECT = 'suspect'  # missed a heartbeat, still gets requests
+    DEAD = 'dead'
+    UNSEEN = 'unseen'  # known from metadata, has not connected since the master started
+    SUSPECT_AFTER = 6  # seconds without heartbeat or ping answer
+    DEAD_AFTER = 15
+    RTT_WEIGHT = 0.2  # weight of a new sample in the RTT moving average
+    LOAD_COST = 0.001  # seconds every request in flight adds to the read cost
+    UNKNOWN_RTT = 0.01  # read cost of a store that was not pinged yet
+
+    def __init__(self, host, port, state=ALIVE):
+        self.host = host
+        self.port = port
+        self.state = state
+        self.last_seen = time.monotonic()
+        self.rtt = None
+        self.free_space = None
+        self.chunk_count = None
+        self.load = 0
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    def is_alive(self):
+        # an unseen store may still hold its replicas, it dies after DEAD_AFTER like a silent one
+        return self.state != self.DEAD
+
+    def is_connected(self):
+        return self.state in (self.ALIVE, self.SUSPECT)
+
+    def seen(self):
+        self.last_seen = time.monotonic()
+        self.state = self.ALIVE
+
+    def heartbeat(self, free_space, chunk_count, load):
+        self.free_space = free_space
+        self.chunk_count = chunk_count
+        self.load = load
+        self.seen()
+
+    def record_rtt(self, rtt):
+        self.rtt = rtt if self.rtt is None else (1 - self.RTT_WEIGHT) * self.rtt + self.RTT_WEIGHT * rtt
+        self.seen()
+
+    def read_cost(self):
+        # expected seconds to answer a read: the RTT and a share of every request in flight
+        return (self.UNKNOWN_RTT if self.rtt is None else self.rtt) + self.load * self.LOAD_COST
+
+    def check(self, now):
+        # returns True when the store has just been declared dead
+        silence = now - self.last_seen
+        if silence > self.DEAD_AFTER:
+            died = self.state != self.DEAD
+            self.state = self.DEAD
+            return died
+        if silence > self.SUSPECT_AFTER and self.state == self.ALIVE:
+            self.state = self.SUSPECT
+        return False
+
+    def to_dict(self):
+        return {
+            'address': f'{self.host}:{self.port}',
+            'state': self.state,
+            'last_seen': round(time.monotonic() - self.last_seen, 3),
+            'rtt': None if self.rtt is None else round(self.rtt, 6),
+            'free_space': self.free_space,
+            'chunk_count': self.chunk_count,
+            'load': self.load,
+        }
@@ -0,0 +1,137 @@
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from protocol import pack_traced
+
+# (trace id, span id) of the span the running task is in, requests sent from it carry it to the next node
+current_span = ContextVar('current_span', default=None)
+
+
+def configure_logging(default='INFO'):
+    # DFS_LOG_LEVEL=DEBUG shows the per chunk and per request lines
+    logging.basicConfig(level=os.environ.get('DFS_LOG_LEVEL', default),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # every opened and closed connection is logged by websockets at INFO
+    logging.getLogger('websockets').setLevel(logging.WARNING)
+
+
+def traced(frame):
+    span = current_span.get()
+    return frame if span is None else pack_traced(frame, *span)
+
+
+class Histogram:
+    # durations in buckets growing by sqrt(2), so observing is a log and an increment
+    BUCKETS = 64
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        microseconds = seconds * 10 ** 6
+        bucket = 0 if microseconds <= 1 else min(int(math.log2(microseconds) * 2) + 1, self.BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, share):
+        # the upper bound of the bucket holding the share, in milliseconds
+        rank, seen = share * self.count, 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(2 ** (bucket / 2) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def snapshot(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3),
+            'p50_ms': round(self.percentile(0.5), 3),
+            'p95_ms': round(self.percentile(0.95), 3),
+            'p99_ms': round(self.percentile(0.99), 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    # counters, gauges read when a snapshot is taken and duration histograms of one node
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}  # name -> function returning the value
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        return {
+            'uptime': round(time.monotonic() - self.started, 3),
+            'counters': dict(self.counters),
+            'gauges': {name: function() for name, function in self.gauges.items()},
+            'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+
+class Tracer:
+    # records spans of sampled requests; a node starts a trace only for its sample rate share of requests,
+    # a request that comes with a trace always gets its span
+    KEEP = 10000  # latest spans kept for the trace command
+
+    def __init__(self, name='', sample_rate=0.0):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=self.KEEP)
+        self.log = logging.getLogger('trace')
+
+    @contextmanager
+    def span(self, operation, parent=None):
+        # yields (trace id, span id), or None when the request is not traced
+        parent = parent or current_span.get()
+        if parent is None and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            yield None
+            return
+        trace_id = parent[0] if parent is not None else f'{random.getrandbits(64):016x}'
+        span = (trace_id, f'{random.getrandbits(64):016x}')
+        token = current_span.set(span)
+        started, started_at = time.perf_counter(), time.time()
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+            record = {
+                'trace': trace_id,
+                'span': span[1],
+                'parent': None if parent is None else parent[1],
+                'node': self.name,
+                'operation': operation,
+                'start': started_at,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            }
+            self.spans.append(record)
+            self.log.debug('%s', record)
+
+    def find(self, trace_id):
+        return [span for span in self.spans if span['trace'] == trace_id]
@@ -1,29 +1,218 @@
+import asyncio
+import inspect
 import json
+import logging
 import re
+import time
 from abc import ABC
+from contextvars import ContextVar
 from typing import Dict, Callable
 
+import websockets
+
+from metrics import Metrics, Tracer
+from pool import BufferPool, ConnectionPool
+from protocol import (BATCH, ERROR_CODES, ERRORS, RESPONSE_HEADER, InvalidArgumentsError, PackedFrame, RemoteError,
+                      UnknownCommandError, frame_id, pack_batch, pack_request, pack_response, set_frame_id,
+                      unpack_request, unpack_response, unwrap_trace)
+
+log = logging.getLogger('node')
+
+
+class Session:
+    # state of one client connection, every connection gets its own
+    def __init__(self, remote_address):
+        self.remote_address = remote_address
+        self.cwd = '/'
+
+
+# every connection is served by its own task, so a context variable holds the session of the request
+current_session = ContextVar('current_session', default=None)
+
+
+def dispatch_table(command_map, takes_payload=False):
+    # command -> (handler, least and most arguments, whether the payload is passed as the last argument),
+    # the arguments of a request are checked against it before the handler is called
+    table = {}
+    for command, handler in command_map.items():
+        parameters = list(inspect.signature(handler).parameters.values())[1:]
+        positional = [parameter for parameter in parameters if parameter.kind != parameter.VAR_POSITIONAL]
+        least = sum(1 for parameter in positional if parameter.default is parameter.empty)
+        most = float('inf') if len(positional) < len(parameters) else len(positional)
+        table[command] = (handler, least, most, takes_payload)
+    return table
+
+
+def raise_error(text):
+    # text commands answer errors as 'ErrorType: message', known types are raised as themselves
+    name, _, message = text.partition(': ')
+    if name in ERROR_CODES:
+        raise ERRORS[ERROR_CODES[name]](message)
+    raise RemoteError(text)
+
 
 class Node(ABC):
     PATTERN = re.compile(r' (?=(?:[^\'"]|\'[^\']*\'|"[^"]*")*$)')
     REPLICAS_NUM = 3
     CHUNK_SIZE = 64 * 2 ** 10  # 64 Kb
+    TRACE_SAMPLE_RATE = 0.0  # share of requests without a trace that start one here
     # CHUNK_SIZE = 64 * 2 ** 5  # 64B
     command_map = Dict[str, Callable]
-    remote_address = None
+    binary_command_map: Dict[str, Callable] = {}
+
+    def __init__(self):
+        self.pool = ConnectionPool()
+        self.buffers = BufferPool(RESPONSE_HEADER + self.CHUNK_SIZE)  # responses built in place, see PackedFrame
+        self.in_flight = 0  # requests being served right now
+        self.local_session = Session(None)  # used by background tasks, outside of any connection
+        self.metrics = Metrics()
+        self.metrics.gauge('in_flight', lambda: self.in_flight)
+        self.tracer = Tracer(sample_rate=self.TRACE_SAMPLE_RATE)
+        self.text_commands = dispatch_table(self.command_map)
+        # binary frames reach the text commands too, a binary command of the same name wins
+        self.binary_commands = {**self.text_commands, **dispatch_table(self.binary_command_map, takes_payload=True)}
+
+    @property
+    def session(self):
+        return current_session.get() or self.local_session
+
+    @property
+    def remote_address(self):
+        return self.session.remote_address
 
     def error(self, *args):
-        print('error during execution')
+        log.debug('error during execution')
         return {'error': "Sorry this command does not exist"}
 
+    def stats(self):
+        return {'body': self.metrics.snapshot()}
+
+    def trace(self, trace_id):
+        # spans of one trace recorded by this node
+        return {'body': self.tracer.find(trace_id)}
+
     async def execute(self, websocket, path):
-        remote_host, remote_ip = websocket.remote_address
-        self.remote_address = f'{remote_host}:{remote_ip}'
-        request = await websocket.recv()
+        remote_host, remote_ip = websocket.remote_address[:2]
+        current_session.set(Session(f'{remote_host}:{remote_ip}'))
+        try:
+            async for request in websocket:
+                if isinstance(request, bytes) and frame_id(request) != 0:
+                    # requests with an id are served concurrently, the reply carries the id
+                    asyncio.ensure_future(self.serve(websocket, request))
+                else:
+                    await self.serve(websocket, request)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def serve(self, websocket, request):
+        self.in_flight += 1
+        self.metrics.count('requests')
+        self.metrics.count('bytes_in', len(request))
+        response = None
+        try:
+            if isinstance(request, bytes):
+                response = await self.execute_binary(request)
+            else:
+                response = json.dumps(await self.run_text(request))
+            await self.acknowledge()
+            self.metrics.count('bytes_out', len(response))
+            await websocket.send(response)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.in_flight -= 1
+            # the frame was copied out by send, its buffer can take the next response
+            self.buffers.release(response)
+
+    async def acknowledge(self):
+        # called before a reply is sent, a node holds it here until the effects of the request are durable
+        pass
+
+    async def run_text(self, request):
         command, *args = request.split(' ')
+        if command not in self.text_commands:
+            return self.error()
+        handler, least, most, _ = self.text_commands[command]
+        if not least <= len(args) <= most:
+            log.debug('Invalid arguments for %s: %d given', command, len(args))
+            return {'error': f'Invalid arguments for {command}: {len(args)} given'}
+        started = time.perf_counter()
+        try:
+            response = handler(self, *args)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except ValueError as error:
+            # the same answers as over binary frames, the connection stays open
+            response = {'error': f'{InvalidArgumentsError.__name__}: {error}'}
+        except Exception as error:
+            log.exception('Request %s failed', command)
+            response = {'error': f'{RemoteError.__name__}: {type(error).__name__}: {error}'}
+        self.metrics.observe(f'latency.{command}', time.perf_counter() - started)
+        if isinstance(response, dict) and response.get('error') is not None:
+            self.metrics.count(f'errors.{command}')
+        return response
+
+    async def run_binary(self, command, args, payload):
+        # returns the result of the command, errors are raised with their own type
+        if command not in self.binary_commands:
+            raise UnknownCommandError(f'Unknown command {command}')
+        handler, least, most, takes_payload = self.binary_commands[command]
+        if takes_payload:
+            args = [*args, payload]
+        if not least <= len(args) <= most:
+            raise InvalidArgumentsError(f'Invalid arguments for {command}: {len(args)} given')
+        started = time.perf_counter()
         try:
-            response = self.command_map.get(command, self.error)(self, *args)
-            await websocket.send(json.dumps(response))
-        except TypeError as error:
-            print('error', f'Invalid arguments for {command}. {type(error).__name__}: ' + str(error))
-            return json.dumps({'error': f'Invalid arguments for {command}. {type(error).__name__}: ' + str(error)})
+            result = handler(self, *args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            if isinstance(result, dict):
+                # text commands answer {'body': result} or {'error': 'ErrorType: message'}
+                if result.get('error') is not None:
+                    raise_error(result['error'])
+                return result.get('body')
+            return result
+        except OSError:
+            self.metrics.count(f'errors.{command}')
+            raise
+        finally:
+            self.metrics.observe(f'latency.{command}', time.perf_counter() - started)
+
+    async def execute_binary(self, request):
+        # returns the response frame, a batch runs its requests in order and answers with their responses
+        request_id, command = 0, None
+        try:
+            request, parent = unwrap_trace(request)
+            kind, request_id, command, args, payload = unpack_request(request)
+            with self.tracer.span(command or 'batch', parent):
+                if kind == BATCH:
+                    responses = [await self.execute_binary(frame) for frame in args]
+                    try:
+                        return pack_batch(responses, request_id)
+                    finally:
+                        for response in responses:
+                            self.buffers.release(response)
+                result = await self.run_binary(command, args, payload)
+                if isinstance(result, PackedFrame):
+                    set_frame_id(result.view, request_id)
+                    return result.view
+                return pack_response(result, request_id=request_id)
+        except ValueError as error:
+            return pack_response(error=InvalidArgumentsError(str(error)), request_id=request_id)
+        except OSError as error:
+            return pack_response(error=error, request_id=request_id)
+        except Exception as error:
+            # a bug in a handler still gets an answer, a request with an id would wait for it forever
+            log.exception('Request %s failed', command or 'batch')
+            return pack_response(error=RemoteError(f'{type(error).__name__}: {error}'), request_id=request_id)
+
+    async def send_pipeline(self, chunk_name, chunk_checksum, stores, payload):
+        # stores are 'host:port' strings, a store that can not be reached is skipped
+        for index, store in enumerate(stores):
+            host, port = store.split(':')
+            request = pack_request('pipeline', chunk_name, chunk_checksum, *stores[index + 1:], payload=payload)
+            try:
+                return unpack_response(await self.pool.request(host, port, request)).split(' ')
+            except (OSError, websockets.ConnectionClosed) as error:
+                log.warning('Pipeline of %s skips %s: %s', chunk_name, store, type(error).__name__)
+        return []
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import websockets
+
+from metrics import traced
+
+
+class ConnectionPool:
+    MAX_SIZE = 8  # connections per (host, port)
+    IDLE_TIMEOUT = 30  # seconds
+
+    def __init__(self, max_size=MAX_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # (host, port) -> [(websocket, released_at)]
+        self.limits = {}  # (host, port) -> semaphore bounding open connections
+
+    @asynccontextmanager
+    async def connection(self, host, port):
+        key = (host, str(port))
+        limit = self.limits.setdefault(key, asyncio.Semaphore(self.max_size))
+        async with limit:
+            websocket = await self.acquire(key)
+            try:
+                yield websocket
+            except BaseException:
+                # the request may be half done, so the socket can not be reused
+                await websocket.close()
+                raise
+            self.release(key, websocket)
+
+    async def request(self, host, port, message):
+        if isinstance(message, bytes):
+            # a request sent inside a traced span carries the trace to the other node
+            message = traced(message)
+        for attempt in range(2):
+            try:
+                async with self.connection(host, port) as websocket:
+                    await websocket.send(message)
+                    return await websocket.recv()
+            except websockets.ConnectionClosed:
+                # a pooled connection was closed by the other side, retry on a fresh one
+                if attempt == 1:
+                    raise
+
+    async def acquire(self, key):
+        idle = self.idle.get(key, [])
+        while len(idle) > 0:
+            websocket, released_at = idle.pop()
+            if websocket.open and time.monotonic() - released_at < self.idle_timeout:
+                return websocket
+            asyncio.ensure_future(websocket.close())
+        host, port = key
+        # no permessage-deflate on any connection: chunks come compressed by their codec or were found
+        # incompressible, deflate would copy and compress every frame again
+        return await websockets.connect(f'ws://{host}:{port}', max_size=None, compression=None)
+
+    def release(self, key, websocket):
+        self.evict_idle()
+        if websocket.open:
+            self.idle.setdefault(key, []).append((websocket, time.monotonic()))
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for key, idle in self.idle.items():
+            alive = [(websocket, released_at) for websocket, released_at in idle
+                     if now - released_at < self.idle_timeout]
+            for websocket, released_at in idle:
+                if now - released_at >= self.idle_timeout:
+                    asyncio.ensure_future(websocket.close())
+            self.idle[key] = alive
+
+    async def close(self):
+        for idle in self.idle.values():
+            for websocket, _ in idle:
+                await websocket.close()
+        self.idle = {}
+
+
+class BufferPool:
+    # reusable buffers for responses built in place, a buffer comes back once its response is sent;
+    # sizes are the base size times a power of two, so batch responses reuse buffers too
+    KEEP = 16 * 2 ** 20  # bytes of free buffers kept
+
+    def __init__(self, size, keep=KEEP):
+        self.size = size
+        self.keep = keep
+        self.kept = 0
+        self.free = {}  # size -> [buffer]
+        self.lent = {}  # id of a lent buffer -> buffer
+
+    def acquire(self, size):
+        # a buffer of at least size bytes
+        capacity = self.size
+        while capacity < size:
+            capacity *= 2
+        free = self.free.get(capacity)
+        if free:
+            buffer = free.pop()
+            self.kept -= capacity
+        else:
+            buffer = bytearray(capacity)
+        self.lent[id(buffer)] = buffer
+        return buffer
+
+    def release(self, frame):
+        # frame is a lent buffer, a view into one or any other response, which is ignored
+        buffer = self.lent.pop(id(frame.obj if isinstance(frame, memoryview) else frame), None)
+        if buffer is not None and self.kept + len(buffer) <= self.keep:
+            self.free.setdefault(len(buffer), []).append(buffer)
+            self.kept += len(buffer)
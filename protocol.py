@@ -0,0 +1,200 @@
+import json
+import struct
+import zlib
+
+# Binary frame layout, version 2
+#   frame: [version: uint8][kind: uint8][request id: uint32][field count: uint16][fields]
+#   field: [type: uint8][length: uint32][value]
+# A request has the command, its arguments and the payload as fields, a response has the result,
+# an error has the error code, name and message. A batch carries whole request or response frames as fields,
+# a traced request carries the trace id, the span id of the caller and the request frame.
+VERSION = 2
+FRAME_HEADER = struct.Struct('!BBIH')
+FIELD_HEADER = struct.Struct('!BI')
+INT = struct.Struct('!q')
+RESPONSE_HEADER = FRAME_HEADER.size + FIELD_HEADER.size  # bytes in front of the result of a response frame
+
+REQUEST, BATCH, RESPONSE, ERROR, TRACE = range(5)  # frame kinds
+BYTES, TEXT, NUMBER, EMPTY, STRUCTURE = range(5)  # field types, a structure is json
+
+
+class PackedFrame:
+    # a response frame a handler built in place around its result, it is sent as it is with the request id set
+    def __init__(self, view):
+        self.view = view
+
+
+class ChecksumError(OSError):
+    pass
+
+
+class RemoteError(OSError):
+    # an error of the other node that has no type of its own here
+    pass
+
+
+class UnknownCommandError(OSError):
+    pass
+
+
+class InvalidArgumentsError(OSError):
+    pass
+
+
+class ProtocolError(OSError):
+    pass
+
+
+# error code -> type, the code is the index, new types go to the end
+ERRORS = [
+    RemoteError,
+    FileNotFoundError,
+    FileExistsError,
+    PermissionError,
+    NotADirectoryError,
+    IsADirectoryError,
+    ConnectionError,
+    ChecksumError,
+    UnknownCommandError,
+    InvalidArgumentsError,
+    ProtocolError,
+]
+ERROR_CODES = {error_type.__name__: code for code, error_type in enumerate(ERRORS)}
+
+
+def checksum(data):
+    # CRC32 from the standard library, every node computes chunk checksums with it
+    return zlib.crc32(data)
+
+
+def pack_field(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        field_type = BYTES
+    elif isinstance(value, str):
+        field_type, value = TEXT, value.encode('utf-8')
+    elif isinstance(value, int) and not isinstance(value, bool):
+        field_type, value = NUMBER, INT.pack(value)
+    elif value is None:
+        field_type, value = EMPTY, b''
+    else:
+        field_type, value = STRUCTURE, json.dumps(value).encode('utf-8')
+    return FIELD_HEADER.pack(field_type, len(value)), value
+
+
+def unpack_field(field_type, value):
+    # bytes stay a view into the frame, nothing is copied
+    if field_type == BYTES:
+        return value
+    if field_type == TEXT:
+        return str(value, 'utf-8')
+    if field_type == NUMBER:
+        return INT.unpack(value)[0]
+    if field_type == EMPTY:
+        return None
+    if field_type == STRUCTURE:
+        return json.loads(bytes(value))
+    raise ProtocolError(f'Unknown field type {field_type}')
+
+
+def pack_frame(kind, request_id, fields):
+    parts = [FRAME_HEADER.pack(VERSION, kind, request_id, len(fields))]
+    for field in fields:
+        parts += pack_field(field)
+    return b''.join(parts)
+
+
+def unpack_frame(frame):
+    view = memoryview(frame)
+    if len(view) < FRAME_HEADER.size:
+        raise ProtocolError('Frame is too short')
+    version, kind, request_id, count = FRAME_HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}')
+    fields, offset = [], FRAME_HEADER.size
+    for _ in range(count):
+        if offset + FIELD_HEADER.size > len(view):
+            raise ProtocolError('Field header runs past the end of the frame')
+        field_type, length = FIELD_HEADER.unpack_from(view, offset)
+        offset += FIELD_HEADER.size
+        if offset + length > len(view):
+            raise ProtocolError('Field runs past the end of the frame')
+        fields.append(unpack_field(field_type, view[offset:offset + length]))
+        offset += length
+    return kind, request_id, fields
+
+
+def pack_request(command, *args, payload=b'', request_id=0):
+    return pack_frame(REQUEST, request_id, [command, *args, payload])
+
+
+def unpack_request(frame):
+    # returns (kind, request id, command, args, payload), a batch has the request frames as args
+    kind, request_id, fields = unpack_frame(frame)
+    if kind == BATCH:
+        return kind, request_id, None, fields, b''
+    if kind != REQUEST or len(fields) < 2 or not isinstance(fields[0], str):
+        raise ProtocolError('Malformed request')
+    return kind, request_id, fields[0], fields[1:-1], fields[-1]
+
+
+def pack_batch(requests, request_id=0):
+    return pack_frame(BATCH, request_id, requests)
+
+
+def pack_traced(frame, trace_id, span_id):
+    return pack_frame(TRACE, frame_id(frame), [trace_id, span_id, frame])
+
+
+def unwrap_trace(frame):
+    # returns the request frame and (trace id, span id) of the caller, None for requests without a trace
+    if len(frame) < FRAME_HEADER.size or FRAME_HEADER.unpack_from(frame)[1] != TRACE:
+        return frame, None
+    kind, request_id, (trace_id, span_id, inner) = unpack_frame(frame)
+    return inner, (trace_id, span_id)
+
+
+def pack_response(result=b'', error=None, request_id=0):
+    # error is an exception or the name of its type
+    if error is None:
+        return pack_frame(RESPONSE, request_id, [result])
+    if isinstance(error, BaseException):
+        name, message = type(error).__name__, str(error)
+    else:
+        name, message = error, ''
+    return pack_frame(ERROR, request_id, [ERROR_CODES.get(name, 0), name, message])
+
+
+def pack_response_into(buffer, offset, length, request_id=0):
+    # the result is already in buffer right after RESPONSE_HEADER bytes from offset, only the headers
+    # are written in front of it; returns a view of the frame, nothing is copied
+    FRAME_HEADER.pack_into(buffer, offset, VERSION, RESPONSE, request_id, 1)
+    FIELD_HEADER.pack_into(buffer, offset + FRAME_HEADER.size, BYTES, length)
+    return memoryview(buffer)[offset:offset + RESPONSE_HEADER + length]
+
+
+def set_frame_id(frame, request_id):
+    version, kind, _, count = FRAME_HEADER.unpack_from(frame)
+    FRAME_HEADER.pack_into(frame, 0, version, kind, request_id, count)
+
+
+def unpack_response(frame):
+    # returns the result, an error of the other node is raised here with its own type
+    kind, request_id, fields = unpack_frame(frame)
+    if kind == ERROR:
+        code, name, message = fields
+        error_type = ERRORS[code] if 0 < code < len(ERRORS) else RemoteError
+        if error_type is RemoteError and name != RemoteError.__name__:
+            message = f'{name}: {message}' if message else name
+        raise error_type(message)
+    if kind == BATCH:
+        return fields
+    if kind != RESPONSE or len(fields) != 1:
+        raise ProtocolError('Malformed response')
+    return fields[0]
+
+
+def frame_id(frame):
+    # the request id without parsing the fields, 0 for frames without an id
+    if len(frame) < FRAME_HEADER.size:
+        return 0
+    return FRAME_HEADER.unpack_from(frame)[2]
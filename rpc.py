@@ -0,0 +1,88 @@
+import asyncio
+import itertools
+
+import websockets
+
+from metrics import traced
+from protocol import frame_id, pack_batch, pack_request, unpack_response
+
+
+def as_reply(frame):
+    # a response frame as a text command gives it: {'body': result} or {'error': 'ErrorType: message'}
+    try:
+        return {'body': unpack_response(frame)}
+    except OSError as error:
+        return {'error': f'{type(error).__name__}: {error}'}
+
+
+class RpcConnection:
+    # many requests in flight over one websocket, every reply carries the id of its request
+    # and may come back out of order
+    TIMEOUT = 60  # seconds to wait for a reply
+
+    def __init__(self, websocket, timeout=TIMEOUT):
+        self.websocket = websocket
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.waiting = {}  # request id -> future of the reply frame
+        self.reader = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def connect(cls, uri):
+        return cls(await websockets.connect(uri, max_size=None, compression=None))
+
+    @property
+    def open(self):
+        return self.websocket.open
+
+    def next_id(self):
+        # id 0 is left for requests answered in order
+        return next(self.ids) % 0xffffffff + 1
+
+    async def read_replies(self):
+        try:
+            async for message in self.websocket:
+                future = self.waiting.pop(frame_id(message), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection to the name node was closed'))
+            self.waiting.clear()
+
+    async def send(self, request_id, frame):
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[request_id] = future
+        await self.websocket.send(traced(frame))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'No reply to request {request_id} within {self.timeout} s')
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def request(self, command, *args, payload=b''):
+        # returns the result, errors of the name node are raised with their own type
+        request_id = self.next_id()
+        return unpack_response(
+            await self.send(request_id, pack_request(command, *args, payload=payload, request_id=request_id)))
+
+    async def call(self, command, *args):
+        request_id = self.next_id()
+        return as_reply(await self.send(request_id, pack_request(command, *args, request_id=request_id)))
+
+    async def batch(self, requests):
+        # requests are (command, *args), they go in one frame and are run in order,
+        # the replies come back as a list
+        if len(requests) == 0:
+            return []
+        request_id = self.next_id()
+        frame = pack_batch([pack_request(*request) for request in requests], request_id)
+        return [as_reply(response) for response in unpack_response(await self.send(request_id, frame))]
+
+    async def close(self):
+        await self.websocket.close(1000, 'closed by client')
+        await self.reader
@@ -0,0 +1,363 @@
+import asyncio
+import base64
+import binascii
+import logging
+import os
+import pickle
+import struct
+import threading
+
+from protocol import ChecksumError, checksum
+
+log = logging.getLogger('storage')
+
+
+class FileStorage:
+    # every chunk is a file, raw chunks get a suffix, legacy base64 chunks keep the bare chunk name
+    RAW_SUFFIX = '.bin'
+    MAINTAIN_INTERVAL = 10  # seconds between manifest saves
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        # the manifest lives next to the folder, so saving it does not change the folder mtime
+        self.manifest_path = f'{root_folder}.manifest'
+        self.chunks = {}  # chunk -> (bytes on disk, checksum or None until the first read)
+        self.used = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.fill_data()
+
+    def fill_data(self):
+        if not os.path.isdir(self.root_folder):
+            os.makedirs(self.root_folder)
+        if not self.load_manifest():
+            with os.scandir(self.root_folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        name = entry.name
+                        if name.endswith(self.RAW_SUFFIX):
+                            name = name[:-len(self.RAW_SUFFIX)]
+                        size = self.chunks.get(name, (0, None))[0] + entry.stat().st_size
+                        self.chunks[name] = (size, None)
+            self.dirty = True
+        self.used = sum(size for size, _ in self.chunks.values())
+
+    def load_manifest(self):
+        # the manifest is trusted only if no chunk file was added or removed after it was saved
+        try:
+            with open(self.manifest_path, 'rb') as file:
+                folder_mtime, chunks = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if folder_mtime != os.stat(self.root_folder).st_mtime_ns:
+            return False
+        self.chunks = chunks
+        return True
+
+    def save_manifest(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            folder_mtime = os.stat(self.root_folder).st_mtime_ns
+            state = pickle.dumps((folder_mtime, self.chunks), protocol=pickle.HIGHEST_PROTOCOL)
+            self.dirty = False
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(state)
+        os.replace(tmp_path, self.manifest_path)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def list(self):
+        return list(self.chunks)
+
+    def get_legacy_path(self, chunk_name):
+        return f'{self.root_folder}/{chunk_name}'
+
+    def get_raw_path(self, chunk_name):
+        return f'{self.root_folder}/{chunk_name}{self.RAW_SUFFIX}'
+
+    def read(self, chunk_name):
+        if chunk_name not in self.chunks:
+            raise FileNotFoundError
+        raw_path = self.get_raw_path(chunk_name)
+        if os.path.isfile(raw_path):
+            with open(raw_path, 'rb') as file:
+                chunk_data = file.read()
+        else:
+            try:
+                with open(self.get_legacy_path(chunk_name), 'r') as file:
+                    chunk_data = base64.b64decode(file.read())
+            except (ValueError, binascii.Error):
+                raise FileNotFoundError
+        self.verify(chunk_name, chunk_data)
+        return chunk_data
+
+    def size(self, chunk_name):
+        # bytes a buffer needs to take the chunk in read_into
+        if chunk_name not in self.chunks:
+            raise FileNotFoundError
+        return self.chunks[chunk_name][0]
+
+    def read_into(self, chunk_name, buffer):
+        # reads the chunk straight into buffer, a writable view of size() bytes; returns the chunk length
+        if chunk_name not in self.chunks:
+            raise FileNotFoundError
+        try:
+            with open(self.get_raw_path(chunk_name), 'rb', buffering=0) as file:
+                length = file.readinto(buffer)
+        except FileNotFoundError:
+            # legacy base64 chunks are decoded and copied, they are smaller than the file
+            chunk_data = self.read(chunk_name)
+            buffer[:len(chunk_data)] = chunk_data
+            return len(chunk_data)
+        self.verify(chunk_name, buffer[:length])
+        return length
+
+    def verify(self, chunk_name, chunk_data):
+        size, stored_checksum = self.chunks[chunk_name]
+        actual_checksum = checksum(chunk_data)
+        if stored_checksum is None:
+            # chunks found on disk at start get their checksum on the first read
+            with self.lock:
+                self.chunks[chunk_name] = (size, actual_checksum)
+                self.dirty = True
+        elif stored_checksum != actual_checksum:
+            raise ChecksumError(f'Chunk {chunk_name} is corrupted')
+
+    def write(self, chunk_name, chunk_data, expected_checksum=None):
+        actual_checksum = checksum(chunk_data)
+        if expected_checksum is not None and actual_checksum != expected_checksum:
+            raise ChecksumError(f'Chunk {chunk_name} was corrupted in transfer')
+        with self.lock:
+            if chunk_name in self.chunks:
+                raise FileExistsError
+            with open(self.get_raw_path(chunk_name), 'wb') as file:
+                file.write(chunk_data)
+            self.chunks[chunk_name] = (len(chunk_data), actual_checksum)
+            self.used += len(chunk_data)
+            self.dirty = True
+
+    def delete(self, chunk_name):
+        with self.lock:
+            size, _ = self.chunks.pop(chunk_name, (None, None))
+            if size is None:
+                return
+            for chunk_path in (self.get_raw_path(chunk_name), self.get_legacy_path(chunk_name)):
+                if os.path.isfile(chunk_path):
+                    os.remove(chunk_path)
+            self.used -= size
+            self.dirty = True
+
+    def used_space(self):
+        return self.used
+
+    async def maintain(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.MAINTAIN_INTERVAL)
+            await loop.run_in_executor(None, self.save_manifest)
+
+
+class SegmentStorage:
+    # chunks are appended to large segment files, deletes append a tombstone record
+    # record: [kind: uint8][name length: uint16][data length: uint32][data checksum: uint32][name][data]
+    RECORD_HEADER = struct.Struct('!BHII')
+    PUT = 1
+    TOMBSTONE = 2
+    SEGMENT_SIZE = 256 * 2 ** 20  # 256Mb
+    COMPACT_RATIO = 0.5  # compact a sealed segment when this part of it is garbage
+    MAINTAIN_INTERVAL = 10  # seconds between index saves and compaction runs
+
+    def __init__(self, root_folder):
+        self.root_folder = f'{root_folder}/segments'
+        self.index_path = f'{self.root_folder}/index'
+        self.index = {}  # chunk -> (segment id, data offset, length, checksum)
+        self.segments = {}  # segment id -> file descriptor
+        self.sizes = {}  # segment id -> bytes
+        self.garbage = {}  # segment id -> bytes of deleted records and tombstones
+        self.active = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root_folder, exist_ok=True)
+        self.load()
+
+    def get_segment_path(self, segment_id):
+        return f'{self.root_folder}/segment-{segment_id:06d}.dat'
+
+    def open_segment(self, segment_id):
+        fd = os.open(self.get_segment_path(segment_id), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segments[segment_id] = fd
+        self.sizes[segment_id] = os.fstat(fd).st_size
+        self.garbage.setdefault(segment_id, 0)
+        return fd
+
+    def load(self):
+        # the saved index covers segments up to a position, records after it are scanned again
+        segment_ids = sorted(int(name[len('segment-'):-len('.dat')]) for name in os.listdir(self.root_folder)
+                             if name.startswith('segment-') and name.endswith('.dat'))
+        for segment_id in segment_ids:
+            self.open_segment(segment_id)
+        scan_segment, scan_offset = 0, 0
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as file:
+                self.index, self.garbage, (scan_segment, scan_offset) = pickle.load(file)
+        end = 0
+        for segment_id in segment_ids:
+            self.garbage.setdefault(segment_id, 0)
+            if segment_id >= scan_segment:
+                end = self.scan(segment_id, scan_offset if segment_id == scan_segment else 0)
+        self.active = segment_ids[-1] if len(segment_ids) > 0 else 0
+        if self.active not in self.segments:
+            self.open_segment(self.active)
+        elif end < self.sizes[self.active]:
+            # a record torn by a crash, new records go right after the last complete one
+            os.ftruncate(self.segments[self.active], end)
+            self.sizes[self.active] = end
+
+    def scan(self, segment_id, offset):
+        fd = self.segments[segment_id]
+        size = self.sizes[segment_id]
+        while offset + self.RECORD_HEADER.size <= size:
+            header = os.pread(fd, self.RECORD_HEADER.size, offset)
+            kind, name_size, data_size, data_checksum = self.RECORD_HEADER.unpack(header)
+            name_offset = offset + self.RECORD_HEADER.size
+            name = os.pread(fd, name_size, name_offset).decode('utf-8')
+            record_end = name_offset + name_size + data_size
+            if record_end > size:
+                break
+            self.drop(name)
+            if kind == self.PUT:
+                self.index[name] = (segment_id, name_offset + name_size, data_size, data_checksum)
+            else:
+                self.garbage[segment_id] += record_end - offset
+            offset = record_end
+        return offset
+
+    def drop(self, chunk_name):
+        location = self.index.pop(chunk_name, None)
+        if location is not None:
+            segment_id, data_offset, length, _ = location
+            name_size = len(chunk_name.encode('utf-8'))
+            self.garbage[segment_id] = self.garbage.get(segment_id, 0) + self.RECORD_HEADER.size + name_size + length
+        return location
+
+    def append(self, kind, chunk_name, chunk_data=b'', data_checksum=0):
+        name = chunk_name.encode('utf-8')
+        if self.sizes[self.active] >= self.SEGMENT_SIZE:
+            self.active += 1
+            self.open_segment(self.active)
+        offset = self.sizes[self.active]
+        record = self.RECORD_HEADER.pack(kind, len(name), len(chunk_data), data_checksum) + name + chunk_data
+        os.write(self.segments[self.active], record)
+        self.sizes[self.active] += len(record)
+        return self.active, offset + self.RECORD_HEADER.size + len(name)
+
+    def __len__(self):
+        return len(self.index)
+
+    def list(self):
+        return list(self.index)
+
+    def read(self, chunk_name):
+        # under the lock, so compaction can not close the segment between the lookup and the pread
+        with self.lock:
+            location = self.index.get(chunk_name)
+            if location is None:
+                raise FileNotFoundError
+            segment_id, data_offset, length, data_checksum = location
+            chunk_data = os.pread(self.segments[segment_id], length, data_offset)
+        if checksum(chunk_data) != data_checksum:
+            raise ChecksumError(f'Chunk {chunk_name} is corrupted')
+        return chunk_data
+
+    def size(self, chunk_name):
+        location = self.index.get(chunk_name)
+        if location is None:
+            raise FileNotFoundError
+        return location[2]
+
+    def read_into(self, chunk_name, buffer):
+        with self.lock:
+            location = self.index.get(chunk_name)
+            if location is None:
+                raise FileNotFoundError
+            segment_id, data_offset, length, data_checksum = location
+            os.preadv(self.segments[segment_id], [buffer[:length]], data_offset)
+        if checksum(buffer[:length]) != data_checksum:
+            raise ChecksumError(f'Chunk {chunk_name} is corrupted')
+        return length
+
+    def write(self, chunk_name, chunk_data, expected_checksum=None):
+        data_checksum = checksum(chunk_data)
+        if expected_checksum is not None and data_checksum != expected_checksum:
+            raise ChecksumError(f'Chunk {chunk_name} was corrupted in transfer')
+        with self.lock:
+            if chunk_name in self.index:
+                raise FileExistsError
+            segment_id, data_offset = self.append(self.PUT, chunk_name, chunk_data, data_checksum)
+            self.index[chunk_name] = (segment_id, data_offset, len(chunk_data), data_checksum)
+
+    def delete(self, chunk_name):
+        with self.lock:
+            if chunk_name in self.index:
+                segment_id, _ = self.append(self.TOMBSTONE, chunk_name)
+                self.drop(chunk_name)
+                self.garbage[segment_id] += self.RECORD_HEADER.size + len(chunk_name.encode('utf-8'))
+
+    def used_space(self):
+        # writes in executor threads may open a new segment meanwhile
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def save_index(self):
+        with self.lock:
+            position = (self.active, self.sizes[self.active])
+            state = pickle.dumps((self.index, self.garbage, position), protocol=pickle.HIGHEST_PROTOCOL)
+            # copied under the lock, writes may add a segment while the fsyncs run;
+            # only compact closes segments and it runs in the same maintenance task
+            fds = list(self.segments.values())
+        for fd in fds:
+            os.fsync(fd)
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(state)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def compact(self):
+        # live chunks of a sealed segment move to the active one, then the segment file is removed
+        with self.lock:
+            segments = [(segment_id, self.sizes[segment_id], self.garbage[segment_id])
+                        for segment_id in self.segments if segment_id != self.active]
+        for segment_id, size, garbage in segments:
+            if size == 0 or garbage / size < self.COMPACT_RATIO:
+                continue
+            with self.lock:
+                live = [name for name, location in self.index.items() if location[0] == segment_id]
+            for name in live:
+                # one chunk per lock hold, so reads and writes go on during compaction
+                with self.lock:
+                    location = self.index.get(name)
+                    if location is None or location[0] != segment_id:
+                        continue
+                    _, data_offset, length, data_checksum = location
+                    chunk_data = os.pread(self.segments[segment_id], length, data_offset)
+                    new_segment, new_offset = self.append(self.PUT, name, chunk_data, data_checksum)
+                    self.index[name] = (new_segment, new_offset, length, data_checksum)
+            # the index has to point at the new copies on disk before the old segment goes away
+            self.save_index()
+            with self.lock:
+                os.close(self.segments.pop(segment_id))
+                del self.sizes[segment_id]
+                del self.garbage[segment_id]
+                os.remove(self.get_segment_path(segment_id))
+            log.info('Compacted segment %d, moved %d chunks', segment_id, len(live))
+
+    async def maintain(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.MAINTAIN_INTERVAL)
+            await loop.run_in_executor(None, self.compact)
+            await loop.run_in_executor(None, self.save_index)
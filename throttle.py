@@ -0,0 +1,21 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    # token bucket, rate is in units (bytes, chunks...) per second
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount or self.tokens >= self.burst:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)